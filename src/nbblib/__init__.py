@@ -1,21 +1,19 @@
 """Convenience package for nbb
 
-How exactly to cleanly import the modules in the future is still unclear,
-so we'll just keep it as is for now.
+The submodules are not imported here, so that e.g. 'nbb --version' does
+not pay for importing all plugin modules. Import them explicitly, as in
+
+    import nbblib.vcs as vcs
+
+nbblib.registry knows which plugins are defined in which modules.
 """
 
-import nbblib.bs as bs
-import nbblib.commands as commands
-import nbblib.nbbcommands as nbbcommands
-import nbblib.plugins as plugins
 import nbblib.package as package
-import nbblib.progutils as progutils
-import nbblib.vcs as vcs
 
 from nbblib.package import PACKAGE_VERSION
 
-__all__ = ['bs', 'commands',
-           'package', 'plugins',
-           'progutils',
+__all__ = ['bs', 'cache', 'commands', 'conffile', 'daemon',
+           'gitrepo', 'history', 'jobserver', 'package', 'plugins',
+           'progutils', 'registry', 'session', 'stages', 'stamps', 'trace',
            'vcs',
            'PACKAGE_VERSION']
@@ -4,10 +4,17 @@ Buildsystem Source Tree plugins
 
 
 import os
+import re
+import shutil
 import logging
 
+from nbblib import cache
+from nbblib import jobserver
 from nbblib import progutils
 from nbblib import plugins
+from nbblib import stages
+from nbblib import stamps
+from nbblib import trace
 
 
 __all__ = []
@@ -32,11 +39,69 @@ class AmbigousBSDetection(plugins.AmbigousPluginDetection):
                                                          '\n  '.join(alist))
 
 
+def _markers_match(tree_root, listing, markers, contents):
+    """Check whether any of the marker files matches
+
+    @param listing set of file names in tree_root
+    @param markers file names or (file name, regexp) pairs
+    @param contents dict caching file contents, shared between calls
+    """
+    for marker in markers:
+        if isinstance(marker, basestring):
+            fname, regexp = marker, None
+        else:
+            fname, regexp = marker
+        if fname not in listing:
+            continue
+        if regexp is None:
+            return True
+        if fname not in contents:
+            try:
+                f = open(os.path.join(tree_root, fname), 'r')
+                try:
+                    contents[fname] = f.read()
+                finally:
+                    f.close()
+            except IOError, e:
+                logging.debug("Cannot read marker file %s: %s",
+                              repr(fname), e)
+                contents[fname] = ''
+        if re.search(regexp, contents[fname], re.MULTILINE):
+            return True
+    return False
+
+
+__all__.append('make_job_args')
+def make_job_args(config, args=(), js=None):
+    """Return make options for parallel jobs, unless args has some already
+
+    With a jobserver js, make must not get a -j option, as that would
+    make it ignore the jobserver.
+    """
+    for arg in args:
+        if (arg.startswith('-j') or arg.startswith('--jobs') or
+            arg.startswith('-l') or arg.startswith('--load-average')):
+            return []
+    jobs, max_load = progutils.parallel_jobs(config.jobs)
+    if js:
+        return ["-l%d" % max_load]
+    return ["-j%d" % jobs, "-l%d" % max_load]
+
+
 __all__.append('BSSourceTree')
 class BSSourceTree(plugins.GenericDetectPlugin):
+    """Mount point for build system plugins
+
+    Plugins declare the files marking a tree as theirs in marker_files:
+    File names relative to the tree root, or (file name, regexp) pairs
+    for files whose content must also match regexp. Any one matching
+    marker file is enough. Plugins are only constructed if one of their
+    marker files matches.
+    """
     __metaclass__ = plugins.GenericPluginMeta
     no_match_exception = NotABSSourceTree
     ambigous_match_exception = AmbigousBSDetection
+    marker_files = ()
 
     @classmethod
     def validate(cls, obj, context, vcs_tree):
@@ -51,133 +116,418 @@ class BSSourceTree(plugins.GenericDetectPlugin):
 
         @param vcs_tree the vcs.VCSourceTree object to examine
         """
-        return super(BSSourceTree, cls).detect(context, vcs_tree)
+        span = trace.Span('detect bs', 'detect',
+                          {'tree_root': vcs_tree.tree_root})
+        try:
+            dcache = cache.DetectionCache(context, vcs_tree.tree_root)
+            name = dcache.lookup('bs')
+            if name in cls.plugins:
+                try:
+                    return cls.detect_named(name, context, vcs_tree)
+                except plugins.PluginNoMatch:
+                    logging.debug("Cached BS type %s does not match", name)
+            obj = super(BSSourceTree, cls).detect(context, vcs_tree)
+            dcache.store('bs', obj.name, obj.tree_root,
+                         cls.all_fingerprint_files())
+            return obj
+        finally:
+            span.end()
+
+    @classmethod
+    def _candidate_keys(cls, context, vcs_tree):
+        """Return names of plugins with matching marker files
+
+        The tree root is listed just once for all plugins, and plugins
+        without matching marker files are not even imported.
+        """
+        tree_root = vcs_tree.tree_root
+        try:
+            listing = frozenset(os.listdir(tree_root))
+        except OSError, e:
+            logging.debug("Cannot list %s: %s", repr(tree_root), e)
+            return []
+        contents = {}
+        keys = []
+        for key in cls.plugins.keys():
+            markers = cls.plugins.peek(key, 'marker_files', ())
+            if _markers_match(tree_root, listing, markers, contents):
+                keys.append(key)
+        logging.debug("BS candidates for %s: %s", repr(tree_root), keys)
+        return keys
+
+    @classmethod
+    def all_fingerprint_files(cls):
+        """Return the marker file names of all registered plugins"""
+        fnames = []
+        for key in cls.plugins.keys():
+            for marker in cls.plugins.peek(key, 'marker_files', ()):
+                if not isinstance(marker, basestring):
+                    marker = marker[0]
+                if marker not in fnames:
+                    fnames.append(marker)
+        fnames.sort()
+        return fnames
 
 
     def get_tree_root(self):
         return self._get_tree_root()
     tree_root = property(get_tree_root)
 
+    _stage_state = None
 
-    def __str__(self):
-        return "BS-Source-Tree(%s, %s)" % (self.name,
-                                           repr(self.tree_root))
+    def get_stage_state(self):
+        """stamps.StageState for this tree's builddir"""
+        if self._stage_state is None:
+            self._stage_state = stamps.StageState(self.config.builddir)
+        return self._stage_state
+    stage_state = property(get_stage_state)
 
-    # Abstract methods
-    @plugins.abstractmethod
-    def _get_tree_root(self):
-        pass
+    def tree_files(self):
+        """List of source files, i.e. without builddir and installdir"""
+        return stamps.tree_files(self.tree_root,
+                                 prune=(self.config.builddir,
+                                        self.config.installdir))
+
+    """Build stages (stages.Stage objects) of the build system"""
+    stages = ()
+
+    """Stages run by a build test"""
+    build_test_stages = ('install', )
+
+    def run_stages(self, *targets):
+        """Run target stages and the stages they depend on, if out of date
+
+        Targets the build system has no stage for are ignored.
+        """
+        names = [ stage.name for stage in self.stages ]
+        targets = [ target for target in targets if target in names ]
+        if targets:
+            stages.Scheduler(self).run(targets)
+
+    _compiler_cache = None
+
+    def get_compiler_cache(self):
+        """cache.CompilerCache if enabled by the config, or None"""
+        if self._compiler_cache is None and self.config.ccache:
+            self._compiler_cache = cache.CompilerCache(self.context,
+                                                       self.tree_root,
+                                                       self.config.ccache)
+        return self._compiler_cache
+    compiler_cache = property(get_compiler_cache)
+
+    def compiler_env(self):
+        """Environment update for programs running compilers"""
+        if self.compiler_cache:
+            return self.compiler_cache.env_update()
+        return {}
+
+    def stage_logfile(self, name):
+        """Log file for the output of the programs stage name runs"""
+        return os.path.join(self.config.builddir, 'nbb-%s.log' % name)
+
+    def run_stage_program(self, stage, call_list, **kwargs):
+        """progutils.prog_run() for a program of stage
+
+        The program logs to stage_logfile(stage), and is killed
+        according to the --timeout and --stall-timeout options.
+        """
+        progutils.prog_run(call_list, self.context,
+                           logfile=self.stage_logfile(stage),
+                           timeout=self.context.timeout,
+                           stall_timeout=self.context.stall_timeout,
+                           **kwargs)
+
+    def forget_stages(self, *names):
+        """Mark stages as out of date"""
+        if self.context and self.context.dry_run:
+            return
+        for name in names:
+            self.stage_state.forget(name)
 
-    @plugins.abstractmethod
     def init(self):
-        pass
+        self.run_stages('init')
 
-    @plugins.abstractmethod
     def configure(self):
-        pass
+        self.run_stages('configure')
 
-    @plugins.abstractmethod
     def build(self):
-        pass
+        self.run_stages('build')
 
-    @plugins.abstractmethod
     def install(self):
+        self._run_cached('install')
+
+    def build_test(self):
+        self._run_cached(*self.build_test_stages)
+
+    def _artifact_params(self):
+        """Build system specific parameters the installed files depend on"""
+        return ()
+
+    def artifact_key(self, acache):
+        """Return artifact cache key for the current tree, or None
+
+        The key covers all source files as they are before building,
+        including untracked ones. So a tree with generated files from
+        an earlier build does not get the same key as a fresh one.
+
+        The installdir is part of the key, as the build system bakes it
+        into the installed files (e.g. as configure --prefix). So only
+        builds of the same branch in the same clone share entries.
+        """
+        content_id = self.vcs_tree.content_id(self.tree_files())
+        if not content_id:
+            return None
+        return acache.key(self.name, content_id, self.config.installdir,
+                          cache.toolchain_fingerprint(os.environ),
+                          self._artifact_params())
+
+    def _run_cached(self, *targets):
+        """Run target stages, unless the artifact cache has their results"""
+        acache = cache.ArtifactCache(self.context)
+        if not acache.enabled:
+            self.run_stages(*targets)
+            return
+        key = self.artifact_key(acache)
+        if key and not self.context.force:
+            if acache.restore(key, self.config.installdir):
+                print "RESTORED:", self.config.installdir
+                return
+        self.run_stages(*targets)
+        if key:
+            acache.store(key, self.config.installdir)
+
+
+    def __str__(self):
+        return "BS-Source-Tree(%s, %s)" % (self.name,
+                                           repr(self.tree_root))
+
+    # Abstract methods
+    @plugins.abstractmethod
+    def _get_tree_root(self):
         pass
 
 
 class AutomakeSourceTree(BSSourceTree):
 
     name = 'automake'
+    marker_files = ('configure.ac', 'configure.in', )
+
+    stages = (stages.Stage('init', '_do_init',
+                           inputs='_init_inputs',
+                           outputs='_init_outputs'),
+              stages.Stage('configure', '_do_configure', deps=('init', ),
+                           inputs='_configure_inputs',
+                           outputs='_configure_outputs',
+                           extra='_configure_extra'),
+              stages.Stage('build', '_do_build', deps=('configure', ),
+                           inputs='tree_files'),
+              stages.Stage('check', '_do_check', deps=('build', ),
+                           inputs='tree_files'),
+              stages.Stage('install', '_do_install', deps=('build', ),
+                           inputs='tree_files',
+                           outputs='_install_outputs'),
+              stages.Stage('install-staging', '_do_install_staging',
+                           deps=('build', ),
+                           inputs='tree_files',
+                           outputs='_install_outputs'),
+              stages.Stage('install-tested', '_do_install_tested',
+                           deps=('check', 'install-staging', ),
+                           outputs='_install_outputs'),
+              )
+
+    # 'make check' runs side by side with 'make install' into a staging
+    # directory, which replaces the installdir once the checks pass.
+    build_test_stages = ('install-tested', )
 
     def __init__(self, context, vcs_tree):
         super(AutomakeSourceTree, self).__init__(context)
-        srcdir = vcs_tree.tree_root
+        self.vcs_tree = vcs_tree
         self.config = vcs_tree.config
-        flag = False
-        for fname in [ os.path.join(srcdir, 'configure.ac'),
-                       os.path.join(srcdir, 'configure.in'),
-                       ]:
-            if os.path.exists(fname):
-                flag = True
-                break
-        if not flag:
-            raise self.no_match_exception(vcs_tree)
 
     def _get_tree_root(self):
         return self.config.srcdir
 
-    def init(self):
+    """Files in any directory which are autoreconf inputs"""
+    init_input_names = ('configure.ac', 'configure.in', 'acinclude.m4',
+                        'Makefile.am', )
+
+    def _init_inputs(self):
+        return [ f for f in self.tree_files()
+                 if (os.path.basename(f) in self.init_input_names or
+                     f.startswith('m4' + os.sep)) ]
+
+    def _init_outputs(self):
+        return [ os.path.join(self.config.srcdir, 'configure') ]
+
+    def _configure_inputs(self):
+        return [ 'configure' ]
+
+    def _configure_outputs(self):
+        return [ os.path.join(self.config.builddir, 'config.status') ]
+
+    def _configure_args(self):
+        args = ["%s/configure" % self.config.srcdir,
+                "--prefix=%s" % self.config.installdir,
+                "--enable-maintainer-mode",
+                ]
+        if not self.context or self.context.config_cache:
+            args.append("--cache-file=%s" % self._cache_file())
+        return args
+
+    def _configure_extra(self):
+        env = self.compiler_env()
+        return (tuple(self._configure_args()), env.get('CC'), env.get('CXX'))
+
+    def _artifact_params(self):
+        args = [ arg for arg in self._configure_args()
+                 if not arg.startswith('--cache-file=') ]
+        return tuple(args)
+
+    def _cache_file(self):
+        return os.path.join(self.config.builddir, 'config.cache')
+
+    def _package_name(self):
+        """PACKAGE_NAME from the configure script, or the tree's name"""
+        try:
+            f = open(os.path.join(self.config.srcdir, 'configure'), 'r')
+            try:
+                m = re.search(r"^PACKAGE_NAME='([^']*)'", f.read(),
+                              re.MULTILINE)
+            finally:
+                f.close()
+            if m and m.group(1):
+                return m.group(1)
+        except IOError, e:
+            logging.debug("Cannot read configure script: %s", e)
+        return os.path.basename(self.tree_root)
+
+    def _install_outputs(self):
+        return [ self.config.installdir ]
+
+    def _staging_dir(self):
+        return os.path.join(self.config.builddir, 'nbb-staging')
+
+    def _do_init(self):
         """'autoreconf'"""
-        progutils.prog_run(["autoreconf", "-v", "-i", "-s", self.config.srcdir],
-                           self.context)
+        self.run_stage_program('init', ["autoreconf", "-v", "-i", "-s",
+                                        self.config.srcdir],
+                               cwd=self.config.srcdir)
 
-    def configure(self):
+    def _do_configure(self):
         """'configure --prefix'"""
-        if not os.path.exists(os.path.join(self.config.srcdir, 'configure')):
-            self.init()
         builddir = self.config.builddir
         if not os.path.exists(builddir):
             os.makedirs(builddir)
-        os.chdir(builddir)
-        progutils.prog_run(["%s/configure" % self.config.srcdir,
-                            "--prefix=%s" % self.config.installdir,
-                            "--enable-maintainer-mode",
-                            ], self.context)
-
-    def make(self, *make_args):
+        env_update = self.compiler_env()
+        env = dict(os.environ)
+        env.update(env_update)
+        acache = cache.AutoconfCache(self.context, self._package_name(), env)
+        acache.fetch(self._cache_file())
+        self.run_stage_program('configure', self._configure_args(),
+                               cwd=builddir, env_update=env_update)
+        acache.store(self._cache_file())
+
+    def _run_make(self, stage, *make_args):
+        js = jobserver.get_jobserver(self.context)
+        self.run_stage_program(stage, ["make"] +
+                               make_job_args(self.config, make_args, js) +
+                               list(make_args), jobserver=js,
+                               cwd=self.config.builddir,
+                               env_update=self.compiler_env())
+
+    def _do_build(self):
         """'make'"""
-        builddir = self.config.builddir
-        if not os.path.exists(os.path.join(builddir, 'config.status')):
-            self.configure()
-        os.chdir(builddir)
-        progutils.prog_run(["make"] + list(make_args), self.context)
+        ccache = self.compiler_cache
+        if ccache and not (self.context and self.context.dry_run):
+            before = ccache.stats()
+            self._run_make('build')
+            ccache.report(before)
+        else:
+            self._run_make('build')
+
+    def _do_check(self):
+        """'make check'"""
+        self._run_make('check', "check")
+
+    def _do_install(self):
+        """'make install'"""
+        self._run_make('install', "install", "INSTALL=/usr/bin/install -p")
+
+    def _do_install_staging(self):
+        """'make install DESTDIR=<staging dir>'"""
+        staging = self._staging_dir()
+        if not (self.context and self.context.dry_run):
+            shutil.rmtree(staging, ignore_errors=True)
+        # Everything is built already, and 'make check' runs meanwhile,
+        # so a single job is enough here.
+        self._run_make('install-staging', "-j1", "install",
+                       "INSTALL=/usr/bin/install -p",
+                       "DESTDIR=%s" % staging)
+
+    def _do_install_tested(self):
+        """Replace the installdir with the staged one"""
+        installdir = self.config.installdir
+        staging = self._staging_dir()
+        staged = os.path.join(staging, installdir.lstrip(os.sep))
+        print "INSTALL:", staged
+        print "  to", installdir
+        if self.context and self.context.dry_run:
+            return
+        if os.path.exists(installdir):
+            shutil.rmtree(installdir)
+        parent = os.path.dirname(installdir)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        shutil.move(staged, installdir)
+        shutil.rmtree(staging, ignore_errors=True)
 
-    def build(self):
+    def make(self, *make_args):
         """'make'"""
-        self.make()
-
-    def install(self):
-        """'make install'"""
-        builddir = self.config.builddir
-        if not os.path.exists(os.path.join(builddir, 'config.status')):
-            self.configure()
-        os.chdir(builddir)
-        progutils.prog_run(["make", "install", "INSTALL=/usr/bin/install -p"],
-                           self.context)
+        self.configure()
+        self._run_make('make', *make_args)
+        # Who knows what the make targets did (e.g. 'clean')
+        self.forget_stages('build', 'check', 'install', 'install-staging',
+                           'install-tested')
 
 
 class SconsSourceTree(BSSourceTree):
 
     name = 'scons'
+    marker_files = ('SConstruct', )
 
     def __init__(self, context, vcs_tree):
         super(SconsSourceTree, self).__init__(context)
-        srcdir = vcs_tree.tree_root
+        self.vcs_tree = vcs_tree
         self.config = vcs_tree.config
-        flag = False
-        for fname in [ os.path.join(srcdir, 'SConstruct'),
-                       ]:
-            if os.path.exists(fname):
-                flag = True
-                break
-        if not flag:
-            raise self.no_match_exception(vcs_tree)
-        self.__tree_root = srcdir
+        self.__tree_root = vcs_tree.tree_root
 
     def _get_tree_root(self):
         return self.__tree_root
 
-    def init(self):
-        pass
-
-    def configure(self):
-        pass
-
-    def build(self):
-        progutils.prog_run(["scons"],
-                           self.context)
-
-    def install(self):
-        progutils.prog_run(["scons", "install"],
-                           self.context)
+    stages = (stages.Stage('build', '_do_build',
+                           inputs='tree_files'),
+              stages.Stage('install', '_do_install', deps=('build', ),
+                           inputs='tree_files'),
+              )
+
+    def _do_build(self):
+        jobs, max_load = progutils.parallel_jobs(self.config.jobs)
+        js = jobserver.get_jobserver(self.context)
+        if not js:
+            self.run_stage_program('build', ["scons", "-j%d" % jobs],
+                                   cwd=self.tree_root)
+        else:
+            # scons knows nothing about jobservers, so take its extra
+            # job slots from the jobserver for it.
+            tokens = js.acquire(jobs - 1)
+            try:
+                self.run_stage_program('build',
+                                       ["scons", "-j%d" % (1 + len(tokens))],
+                                       cwd=self.tree_root)
+            finally:
+                js.release(tokens)
+
+    def _do_install(self):
+        self.run_stage_program('install', ["scons", "install"],
+                               cwd=self.tree_root)
 
@@ -0,0 +1,580 @@
+"""\
+nbblib.cache - persistent caches kept between nbb runs
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+The caches live below $NBB_CACHE_DIR, or $XDG_CACHE_HOME/nbb, or
+~/.cache/nbb, in that order of preference. All caches are strictly
+best effort: Any problem reading or writing them is logged and
+otherwise ignored.
+"""
+
+
+import os
+import stat
+import errno
+import fcntl
+import re
+import logging
+import marshal
+import shutil
+import hashlib
+import tarfile
+import subprocess
+
+
+__all__ = []
+
+
+__all__.append('get_cache_dir')
+def get_cache_dir(*subdirs):
+    """Return absolute path of (and create) nbb cache directory"""
+    topdir = os.environ.get('NBB_CACHE_DIR')
+    if not topdir:
+        xdg_dir = os.environ.get('XDG_CACHE_HOME')
+        if not xdg_dir:
+            xdg_dir = os.path.join(os.path.expanduser('~'), '.cache')
+        topdir = os.path.join(xdg_dir, 'nbb')
+    cdir = os.path.abspath(os.path.join(topdir, *subdirs))
+    if not os.path.isdir(cdir):
+        try:
+            os.makedirs(cdir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    return cdir
+
+
+__all__.append('fingerprint')
+def fingerprint(topdirs, fnames):
+    """Return a comparable fingerprint of the given files' stat data
+
+    Every combination of a directory from topdirs and a relative file
+    name from fnames contributes either its (inode, size, mtime), just
+    'dir' for directories (whose mtime changes far too often to be
+    useful), or None if the file does not exist.
+    """
+    fp = []
+    for topdir in topdirs:
+        for fname in fnames:
+            try:
+                st = os.stat(os.path.join(topdir, fname))
+            except OSError:
+                fp.append((topdir, fname, None))
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                fp.append((topdir, fname, 'dir'))
+            else:
+                fp.append((topdir, fname,
+                           (st.st_ino, st.st_size, st.st_mtime)))
+    return tuple(fp)
+
+
+__all__.append('write_atomically')
+def write_atomically(filename, data):
+    """Replace the content of filename with data in one atomic step"""
+    tmpname = "%s.%d.tmp" % (filename, os.getpid())
+    f = open(tmpname, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmpname, filename)
+
+
+# filename -> ((inode, size, mtime), (srcdir, entries))
+_detection_files = {}
+
+
+def _read_detection_file(filename):
+    """Return (srcdir, entries) from a detection cache file
+
+    Like nbblib.conffile, every file is read at most once per process
+    and version of the file.
+    """
+    st = os.stat(filename)
+    key = (st.st_ino, st.st_size, st.st_mtime)
+    if filename in _detection_files and _detection_files[filename][0] == key:
+        return _detection_files[filename][1]
+    f = open(filename, 'rb')
+    try:
+        contents = marshal.load(f)
+    finally:
+        f.close()
+    _detection_files[filename] = (key, contents)
+    return contents
+
+
+__all__.append('DetectionCache')
+class DetectionCache(object):
+    """Plugin detection results persisted for one source directory
+
+    Every entry maps a kind of detection ('vcs', 'bs') to the name of
+    the detected plugin, and is valid only as long as the fingerprint
+    of the files the detection depends on stays the same.
+    """
+
+    def __init__(self, context, srcdir):
+        super(DetectionCache, self).__init__()
+        self.srcdir = srcdir
+        self.enabled = not (context and not context.detect_cache)
+        self._entries = None
+        self._filename = None
+
+    def _get_filename(self):
+        if not self._filename:
+            self._filename = os.path.join(get_cache_dir('detect'),
+                                          hashlib.md5(self.srcdir).hexdigest())
+        return self._filename
+    filename = property(_get_filename)
+
+    def _get_entries(self):
+        if self._entries is None:
+            self._entries = {}
+            try:
+                srcdir, entries = _read_detection_file(self.filename)
+                if srcdir == self.srcdir:
+                    self._entries = dict(entries)
+            except (IOError, OSError, EOFError, ValueError, TypeError), e:
+                logging.debug("Cannot read detection cache %s: %s",
+                              repr(self.filename), e)
+        return self._entries
+    entries = property(_get_entries)
+
+    def lookup(self, kind):
+        """Return cached plugin name for kind, or None"""
+        if not self.enabled or kind not in self.entries:
+            return None
+        name, tree_root, fnames, fp = self.entries[kind]
+        if fp != fingerprint(self._topdirs(tree_root), fnames):
+            logging.debug("Detection cache for %s %s is stale",
+                          kind, repr(self.srcdir))
+            return None
+        logging.debug("Detection cache hit for %s %s: %s",
+                      kind, repr(self.srcdir), name)
+        return name
+
+    def store(self, kind, name, tree_root, fnames):
+        """Remember name as the detected plugin for kind"""
+        if not self.enabled:
+            return
+        fnames = tuple(fnames)
+        fp = fingerprint(self._topdirs(tree_root), fnames)
+        self.entries[kind] = (name, tree_root, fnames, fp)
+        try:
+            write_atomically(self.filename,
+                             marshal.dumps((self.srcdir, self.entries)))
+        except (IOError, OSError), e:
+            logging.debug("Cannot write detection cache %s: %s",
+                          repr(self.filename), e)
+
+    def _topdirs(self, tree_root):
+        if tree_root == self.srcdir:
+            return (self.srcdir, )
+        return (self.srcdir, tree_root, )
+
+
+def _find_program(name, path):
+    """Return the real absolute path of program name in path, or None"""
+    if os.sep in name:
+        candidates = [ name ]
+    else:
+        candidates = [ os.path.join(pdir, name)
+                       for pdir in path.split(os.pathsep) if pdir ]
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.realpath(candidate)
+    return None
+
+
+_cache_line_re = re.compile(r'^(?:([A-Za-z_][A-Za-z0-9_]*)=|'
+                            r'test "\$\{([A-Za-z_][A-Za-z0-9_]*)\+set\}")')
+
+
+def _parse_cache_entries(text):
+    """Split autoconf cache file text into {variable: lines}
+
+    Lines not starting a new entry (e.g. of multi-line values) belong to
+    the entry before them. Entries of the ac_cv_env_* variables, which
+    hold the values of configure's precious variables, are left out:
+    configure refuses to run with a cache from a run with different
+    precious variables, and those differ between packages.
+    """
+    entries = {}
+    name = None
+    for line in text.splitlines(True):
+        m = _cache_line_re.match(line)
+        if m:
+            name = m.group(1) or m.group(2)
+            entries[name] = line
+        elif name:
+            entries[name] += line
+    for name in entries.keys():
+        if name.startswith('ac_cv_env_'):
+            del entries[name]
+        elif not entries[name].endswith('\n'):
+            entries[name] += '\n'
+    return entries
+
+
+"""Environment variables affecting what compilers and configure do"""
+TOOLCHAIN_ENV_VARS = ('CC', 'CFLAGS', 'CPP', 'CPPFLAGS', 'CXX', 'CXXCPP',
+                      'CXXFLAGS', 'LDFLAGS', 'LIBS', 'PATH',
+                      'PKG_CONFIG', 'PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR', )
+
+
+"""Compilers configure looks for if $CC/$CXX are not set"""
+_DEFAULT_COMPILERS = (('CC', ('gcc', 'cc')),
+                      ('CXX', ('g++', 'c++')))
+
+
+__all__.append('toolchain_fingerprint')
+def toolchain_fingerprint(env):
+    """Return tuple identifying host, toolchain and environment
+
+    The toolchain is identified by the environment variables in
+    TOOLCHAIN_ENV_VARS, and by the C and C++ compilers they select
+    (real path, size and mtime). A ccache in $CC or $CXX is looked
+    through, as it does not change what the compiler produces.
+    """
+    uname = os.uname()
+    ident = [ uname[1], uname[4] ]
+    path = env.get('PATH', os.defpath)
+    for var in TOOLCHAIN_ENV_VARS:
+        ident.append((var, env.get(var)))
+    for var, defaults in _DEFAULT_COMPILERS:
+        names = env.get(var, '').split()
+        while names and os.path.basename(names[0]) == 'ccache':
+            names = names[1:]
+        if names:
+            names = names[:1]
+        else:
+            names = defaults
+        for name in names:
+            prog = _find_program(name, path)
+            if prog:
+                st = os.stat(prog)
+                ident.append((var, prog, st.st_size, st.st_mtime))
+                break
+        else:
+            ident.append((var, None))
+    return tuple(ident)
+
+
+__all__.append('AutoconfCache')
+class AutoconfCache(object):
+    """autoconf config.cache shared by all builddirs of a package
+
+    There is one shared cache file per host, package and toolchain
+    (see toolchain_fingerprint()), so that e.g. a compiler upgrade
+    starts a new cache.
+
+    configure never writes the shared file itself, as several configure
+    runs may happen at the same time: A builddir's config.cache is
+    filled from the shared file before configure runs, and the results
+    are merged back into the shared file afterwards, holding a lock on
+    the shared file's .lock file.
+    """
+
+    def __init__(self, context, package, env=None):
+        super(AutoconfCache, self).__init__()
+        self.package = package
+        self.enabled = not (context and (not context.config_cache or
+                                         context.dry_run))
+        if env is None:
+            env = os.environ
+        self.env = env
+        self._filename = None
+
+    def _get_filename(self):
+        if not self._filename:
+            key = hashlib.md5(repr((self.package,
+                                    toolchain_fingerprint(self.env))))
+            self._filename = os.path.join(get_cache_dir('autoconf'),
+                                          "%s.cache" % key.hexdigest())
+        return self._filename
+    filename = property(_get_filename)
+
+    def fetch(self, cache_file):
+        """Fill configure cache file cache_file from the shared cache"""
+        if not self.enabled:
+            return
+        try:
+            f = open(self.filename, 'r')
+            try:
+                text = f.read()
+            finally:
+                f.close()
+            write_atomically(cache_file, text)
+            logging.debug("Using autoconf cache %s for %s",
+                          repr(self.filename), repr(cache_file))
+        except (IOError, OSError), e:
+            logging.debug("Cannot use autoconf cache %s: %s",
+                          repr(self.filename), e)
+
+    def store(self, cache_file):
+        """Merge configure cache file cache_file into the shared cache"""
+        if not self.enabled:
+            return
+        try:
+            lockfd = os.open(self.filename + '.lock',
+                             os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                # Concurrent configure runs must not lose each
+                # other's entries
+                fcntl.flock(lockfd, fcntl.LOCK_EX)
+                self._merge(cache_file)
+            finally:
+                os.close(lockfd)
+        except (IOError, OSError), e:
+            logging.debug("Cannot update autoconf cache %s: %s",
+                          repr(self.filename), e)
+
+    def _merge(self, cache_file):
+        entries = {}
+        for fname in (self.filename, cache_file):
+            try:
+                f = open(fname, 'r')
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                entries.update(_parse_cache_entries(f.read()))
+            finally:
+                f.close()
+        names = entries.keys()
+        names.sort()
+        write_atomically(self.filename,
+                         ''.join([ entries[name] for name in names ]))
+
+
+# 'ccache -s' counter lines of ccache before 4.0
+_ccache_stats_re = re.compile(r'^(cache hit \(direct\)|'
+                              r'cache hit \(preprocessed\)|'
+                              r'cache miss)\s+([0-9]+)\s*$')
+
+
+__all__.append('CompilerCache')
+class CompilerCache(object):
+    """ccache wrapping the compilers of all builddirs of a source tree
+
+    The compilers are wrapped by setting CC and CXX for configure. The
+    ccache directory is shared by all builddirs of the source tree, and
+    ccache is told to ignore the differing builddir paths, so that
+    building a branch resembling one built before mostly hits the cache.
+    ccache itself evicts old entries when the size limit is reached.
+    """
+
+    def __init__(self, context, tree_root, size_limit=None, env=None):
+        super(CompilerCache, self).__init__()
+        self.tree_root = tree_root
+        self.size_limit = size_limit
+        if env is None:
+            env = os.environ
+        self.env = env
+        self.program = _find_program('ccache', env.get('PATH', os.defpath))
+        if not self.program:
+            logging.warning("Compiler cache 'ccache' not found, "
+                            "building without it")
+        self._directory = None
+
+    def _get_directory(self):
+        if not self._directory:
+            self._directory = get_cache_dir('ccache',
+                                            hashlib.md5(self.tree_root).hexdigest())
+        return self._directory
+    directory = property(_get_directory)
+
+    def _ccache_env(self):
+        env = {'CCACHE_DIR': self.directory,
+               'CCACHE_BASEDIR': self.tree_root,
+               'CCACHE_NOHASHDIR': '1',
+               }
+        if self.size_limit and self.size_limit != 'on':
+            env['CCACHE_MAXSIZE'] = self.size_limit
+        return env
+
+    def env_update(self):
+        """Return environment update for running configure and make"""
+        if not self.program:
+            return {}
+        env = self._ccache_env()
+        for var, compiler in (('CC', 'gcc'), ('CXX', 'g++')):
+            value = self.env.get(var, '').strip()
+            if not value:
+                value = compiler
+            if os.path.basename(value.split()[0]) != 'ccache':
+                value = "%s %s" % (self.program, value)
+            env[var] = value
+        return env
+
+    def _run(self, option):
+        """Run ccache with option, return (exit code, stdout, stderr)"""
+        env = dict(self.env)
+        env.update(self._ccache_env())
+        proc = subprocess.Popen([self.program, option], env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        return proc.returncode, stdout, stderr
+
+    def stats(self):
+        """Return (hits, misses) counted by ccache so far, or None
+
+        ccache 4.0 and later have machine readable --print-stats, for
+        older versions the 'ccache -s' summary is parsed.
+        """
+        if not self.program:
+            return None
+        ret, stdout, stderr = self._run('--print-stats')
+        if ret == 0:
+            counters = {}
+            for line in stdout.splitlines():
+                fields = line.split('\t')
+                if len(fields) == 2 and fields[1].isdigit():
+                    counters[fields[0]] = int(fields[1])
+            hits = (counters.get('direct_cache_hit', 0) +
+                    counters.get('preprocessed_cache_hit', 0))
+            return hits, counters.get('cache_miss', 0)
+        logging.debug("ccache --print-stats failed: %s", stderr.strip())
+        ret, stdout, stderr = self._run('-s')
+        counters = {}
+        if ret == 0:
+            for line in stdout.splitlines():
+                match = _ccache_stats_re.match(line)
+                if match:
+                    counters[match.group(1)] = int(match.group(2))
+        if 'cache miss' not in counters:
+            logging.info("Cannot get ccache statistics: %s",
+                         stderr.strip() or "unknown 'ccache -s' output")
+            return None
+        hits = (counters.get('cache hit (direct)', 0) +
+                counters.get('cache hit (preprocessed)', 0))
+        return hits, counters['cache miss']
+
+    def report(self, before):
+        """Print hit rate since before, the stats() result from then"""
+        after = self.stats()
+        if not before or not after:
+            return
+        hits = after[0] - before[0]
+        misses = after[1] - before[1]
+        if hits + misses == 0:
+            print "Compiler cache: nothing compiled"
+            return
+        print "Compiler cache: %d hits, %d misses (%d%% hit rate)" % \
+            (hits, misses, 100 * hits / (hits + misses))
+
+
+__all__.append('ArtifactCache')
+class ArtifactCache(object):
+    """Compressed installdir contents, keyed by what they were built from
+
+    The key is made from the source tree contents (e.g. a hash of the
+    git index), the toolchain and the build system's own parameters, so
+    that an entry can be restored instead of building the same thing
+    again. The installdir path is part of the key, too, as installed
+    files may contain it: Hits only happen for the same branch in the
+    same clone, e.g. after switching back to a branch or reverting a
+    change. The cache directory is shared by all source trees on the
+    host, but they do not share entries. When its size exceeds the
+    limit ($NBB_ARTIFACT_CACHE_SIZE in bytes, or 1GiB), the
+    least recently used entries are removed.
+    """
+
+    default_max_size = 1 << 30
+
+    def __init__(self, context):
+        super(ArtifactCache, self).__init__()
+        self.enabled = (context and context.artifact_cache and
+                        not context.dry_run)
+        try:
+            self.max_size = int(os.environ['NBB_ARTIFACT_CACHE_SIZE'])
+        except (KeyError, ValueError):
+            self.max_size = self.default_max_size
+
+    def key(self, *parts):
+        """Return cache key for parts, which must have a stable repr()"""
+        return hashlib.md5(repr(parts)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(get_cache_dir('artifacts'), "%s.tar.gz" % key)
+
+    def restore(self, key, installdir):
+        """Replace installdir with the cached one, return True on a hit"""
+        if not self.enabled:
+            return False
+        path = self._path(key)
+        if not os.path.exists(path):
+            logging.debug("Artifact cache miss for %s", key)
+            return False
+        tmpdir = "%s.nbb-restore.%d" % (installdir, os.getpid())
+        olddir = "%s.nbb-old.%d" % (installdir, os.getpid())
+        try:
+            tar = tarfile.open(path, 'r:gz')
+            try:
+                tar.extractall(tmpdir)
+            finally:
+                tar.close()
+            if os.path.exists(installdir):
+                os.rename(installdir, olddir)
+            os.rename(tmpdir, installdir)
+            shutil.rmtree(olddir, ignore_errors=True)
+            # The mtime marks when the entry has last been used
+            os.utime(path, None)
+        except (IOError, OSError, tarfile.TarError), e:
+            logging.warning("Cannot restore %s from artifact cache: %s",
+                            repr(installdir), e)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return False
+        return True
+
+    def store(self, key, installdir):
+        """Put the contents of installdir into the cache"""
+        if not self.enabled or not os.path.isdir(installdir):
+            return
+        path = self._path(key)
+        if os.path.exists(path):
+            os.utime(path, None)
+            return
+        tmpname = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            tar = tarfile.open(tmpname, 'w:gz')
+            try:
+                tar.add(installdir, arcname='.')
+            finally:
+                tar.close()
+            os.rename(tmpname, path)
+        except (IOError, OSError, tarfile.TarError), e:
+            logging.warning("Cannot store %s in artifact cache: %s",
+                            repr(installdir), e)
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is small enough"""
+        cdir = get_cache_dir('artifacts')
+        entries = []
+        total = 0
+        for fname in os.listdir(cdir):
+            if not fname.endswith('.tar.gz'):
+                continue
+            try:
+                st = os.stat(os.path.join(cdir, fname))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+            total += st.st_size
+        entries.sort()
+        # Never remove the most recent entry, however large it is
+        for mtime, size, fname in entries[:-1]:
+            if total <= self.max_size:
+                break
+            logging.debug("Evicting %s from artifact cache", fname)
+            try:
+                os.unlink(os.path.join(cdir, fname))
+            except OSError:
+                continue
+            total -= size
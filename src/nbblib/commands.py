@@ -107,6 +107,22 @@ class Command(object):
         return "Command(%s, %s)" % (self.name, self.cmdargs)
 
 
+__all__.append('command_name')
+def command_name(args):
+    """Return the command in command line args (without argv0), or None
+
+    That is the first argument after the global options.
+    """
+    i = 0
+    while i < len(args) and args[i][:1] == '-':
+        if args[i] in ('-b', '--build-system', '-v', '--vcs'):
+            i += 1
+        i += 1
+    if i < len(args):
+        return args[i]
+    return None
+
+
 __all__.append('Commander')
 class Commander(object):
     """Represent cmdline command (parse args, find and run the command)"""
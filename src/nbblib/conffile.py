@@ -0,0 +1,140 @@
+"""\
+nbblib.conffile - nbb's own config file ${srcdir}/.nbb.conf
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+The file consists of lines of the form
+
+    item = value
+
+Empty lines and lines starting with '#' are ignored. Values extend to
+the end of the line, with surrounding whitespace removed.
+
+Every file is parsed at most once per process and version of the file:
+The parsed items are kept together with the file's stat data, so that
+reading an unchanged file costs just one stat() call. Writing replaces
+the whole file atomically.
+"""
+
+
+import os
+import errno
+import logging
+
+from nbblib import cache
+
+
+__all__ = []
+
+
+__all__.append('CONFIG_FILE_NAME')
+CONFIG_FILE_NAME = '.nbb.conf'
+
+
+__all__.append('ConfigFileError')
+class ConfigFileError(RuntimeError):
+    """Malformed config file"""
+    def __init__(self, filename, lineno, msg):
+        super(ConfigFileError, self).__init__()
+        self.filename = filename
+        self.lineno = lineno
+        self.msg = msg
+    def __str__(self):
+        return "%s:%d: %s" % (self.filename, self.lineno, self.msg)
+
+
+# filename -> ((inode, size, mtime), items dict)
+_parsed = {}
+
+
+def _parse_line(line, filename, lineno):
+    """Return (item, value) for line, or None for empty and comment lines"""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if '=' not in line:
+        raise ConfigFileError(filename, lineno, "expected 'item = value'")
+    item, value = line.split('=', 1)
+    item = item.strip()
+    if not item or len(item.split()) != 1:
+        raise ConfigFileError(filename, lineno, "bad item name %s" % repr(item))
+    return item, value.strip()
+
+
+__all__.append('parse')
+def parse(text, filename='<string>'):
+    """Parse config file contents into a dict"""
+    items = {}
+    lineno = 0
+    for line in text.splitlines():
+        lineno += 1
+        parsed = _parse_line(line, filename, lineno)
+        if parsed:
+            items[parsed[0]] = parsed[1]
+    return items
+
+
+def _read_text(filename):
+    try:
+        f = open(filename, 'r')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return ''
+        raise
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+__all__.append('read')
+def read(filename):
+    """Return dict of config items in filename (empty if file does not exist)
+
+    The returned dict is shared between callers and must not be modified.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            _parsed.pop(filename, None)
+            return {}
+        raise
+    key = (st.st_ino, st.st_size, st.st_mtime)
+    if filename in _parsed and _parsed[filename][0] == key:
+        return _parsed[filename][1]
+    items = parse(_read_text(filename), filename)
+    logging.debug("Read %d config items from %s", len(items), repr(filename))
+    _parsed[filename] = (key, items)
+    return items
+
+
+__all__.append('update')
+def update(filename, items):
+    """Set the config items from dict items in filename
+
+    Lines setting other items, comments and the order of lines are
+    kept as they are. Existing items are changed in place, new items
+    are appended.
+    """
+    if not items:
+        return
+    for item, value in items.iteritems():
+        if '\n' in value or value != value.strip():
+            raise RuntimeError("Cannot store %s value %s in config file"
+                             % (item, repr(value)))
+    lines = _read_text(filename).splitlines()
+    todo = items.copy()
+    lineno = 0
+    for line in lines:
+        parsed = _parse_line(line, filename, lineno + 1)
+        if parsed and parsed[0] in items:
+            lines[lineno] = "%s = %s" % (parsed[0], items[parsed[0]])
+            todo.pop(parsed[0], None)
+        lineno += 1
+    keys = todo.keys()
+    keys.sort()
+    for item in keys:
+        lines.append("%s = %s" % (item, todo[item]))
+    lines.append('')
+    cache.write_atomically(filename, '\n'.join(lines))
+    _parsed.pop(filename, None)
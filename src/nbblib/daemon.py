@@ -0,0 +1,422 @@
+"""\
+nbblib.daemon - nbbd, a long-lived nbb process answering nbb commands
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+'nbb daemon' starts nbbd listening on a Unix socket (by default
+nbbd.sock in the nbb cache directory). With NBB_DAEMON set to that
+socket's path, nbb does not run commands itself, but sends argv, the
+current directory and the environment to nbbd, and shows the output
+streamed back.
+
+nbbd has imported nbblib and all plugin modules once, and keeps the
+per-process caches (parsed .nbb.conf files, detection cache files)
+warm for the source trees it has seen. Every command runs in a process
+forked from nbbd, so it starts out with all that, and cannot disturb
+nbbd or other commands. The caches check the stat() data of the files
+they depend on before every use, so changed files are noticed. When
+nbblib itself changes, nbbd exits, and nbb runs commands on its own
+until a new nbbd is started.
+
+Commands run by nbbd get /dev/null as stdin, so interactive commands
+(e.g. run-sh without a command) do not work through nbbd.
+
+The protocol: Both sides send frames of a kind byte, a 4 byte length
+and the payload. The client sends a 'q' frame with the marshalled
+(PACKAGE_VERSION, argv, cwd, environ) request (argv None for a shutdown
+request). nbbd answers with 'o' and 'e' frames for stdout and stderr
+data, and finally an 'x' frame with the exit code. If the versions
+differ, nbbd answers with just an 'r' frame, and nbb runs the command
+itself.
+"""
+
+
+import os
+import sys
+import errno
+import select
+import signal
+import socket
+import struct
+import marshal
+import logging
+
+from nbblib import package
+
+
+__all__ = []
+
+
+__all__.append('SOCKET_NAME')
+SOCKET_NAME = 'nbbd.sock'
+
+
+_HEADER = '!cI'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+
+def _send_frame(sock, kind, data=''):
+    sock.sendall(struct.pack(_HEADER, kind, len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        try:
+            chunk = sock.recv(size)
+        except socket.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv_frame(sock):
+    """Return (kind, data) of the next frame, or None at EOF"""
+    header = _recv_exactly(sock, _HEADER_SIZE)
+    if header is None:
+        return None
+    kind, size = struct.unpack(_HEADER, header)
+    data = _recv_exactly(sock, size)
+    if data is None:
+        return None
+    return kind, data
+
+
+def _connect(path):
+    """Return socket connected to nbbd at path, or None"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error, e:
+        logging.debug("Cannot connect to nbbd at %s: %s", repr(path), e)
+        sock.close()
+        return None
+    return sock
+
+
+__all__.append('default_socket')
+def default_socket():
+    from nbblib import cache
+    return os.path.join(cache.get_cache_dir(), SOCKET_NAME)
+
+
+__all__.append('client')
+def client(path, argv):
+    """Run nbb command argv through nbbd at path
+
+    Return the exit code, or None if there is no nbbd to run it (or if
+    the command must not run there), so that the caller runs it.
+    Commands with --profile run locally, as profiling nbbd's command
+    process is not what the user asks for.
+    """
+    from nbblib.commands import command_name
+    if command_name(argv[1:]) == 'daemon':
+        return None
+    for arg in argv[1:]:
+        if arg[:1] != '-':
+            break
+        if arg == '--profile' or arg[:10] == '--profile=':
+            return None
+    sock = _connect(path)
+    if sock is None:
+        return None
+    try:
+        _send_frame(sock, 'q', marshal.dumps((package.PACKAGE_VERSION,
+                                              list(argv), os.getcwd(),
+                                              dict(os.environ))))
+        while True:
+            frame = _recv_frame(sock)
+            if frame is None:
+                print >>sys.stderr, "nbb: Lost connection to nbbd"
+                return 3
+            kind, data = frame
+            if kind == 'o':
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            elif kind == 'e':
+                sys.stderr.write(data)
+                sys.stderr.flush()
+            elif kind == 'x':
+                return int(data)
+            elif kind == 'r':
+                logging.debug("nbbd refuses request: %s", data)
+                return None
+    finally:
+        sock.close()
+
+
+__all__.append('stop')
+def stop(path):
+    """Ask nbbd at path to exit; return False if it is not running"""
+    sock = _connect(path)
+    if sock is None:
+        return False
+    try:
+        _send_frame(sock, 'q', marshal.dumps((package.PACKAGE_VERSION,
+                                              None, None, None)))
+        _recv_frame(sock)
+    finally:
+        sock.close()
+    return True
+
+
+__all__.append('is_running')
+def is_running(path):
+    sock = _connect(path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+__all__.append('DaemonRunning')
+class DaemonRunning(RuntimeError):
+    def __init__(self, path):
+        super(DaemonRunning, self).__init__()
+        self.path = path
+    def __str__(self):
+        return "nbbd is already running on %s" % repr(self.path)
+
+
+def _nbblib_files():
+    """Return (directory, source file names) of the loaded nbblib modules"""
+    libdir = os.path.dirname(os.path.abspath(package.__file__))
+    fnames = set()
+    for name, module in sys.modules.items():
+        mfile = getattr(module, '__file__', None)
+        if name.startswith('nbblib.') and mfile:
+            fnames.add(os.path.splitext(os.path.basename(mfile))[0] + '.py')
+    fnames = list(fnames)
+    fnames.sort()
+    return libdir, fnames
+
+
+def _warm(cwd):
+    """Fill the per-process caches for commands run in cwd"""
+    from nbblib import cache, conffile
+    try:
+        entries = cache.DetectionCache(None, cwd).entries
+        for name, tree_root, fnames, fp in entries.values():
+            conffile.read(os.path.join(tree_root, conffile.CONFIG_FILE_NAME))
+    except Exception, e:
+        logging.debug("Cannot warm caches for %s: %s", repr(cwd), e)
+
+
+def _set_loglevel(argv):
+    """Act on and remove --debug and --info like the nbb script does"""
+    for option, level in (('--info', logging.INFO),
+                          ('--debug', logging.DEBUG)):
+        while option in argv:
+            argv.remove(option)
+            logging.getLogger().setLevel(level)
+
+
+def _run_command(argv, cwd, env, out_fd, err_fd):
+    """In the forked command process: run argv, and never return"""
+    code = 1
+    try:
+        try:
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.dup2(out_fd, 1)
+            os.dup2(err_fd, 2)
+            for fd in (devnull, out_fd, err_fd):
+                os.close(fd)
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(env)
+            _set_loglevel(argv)
+            logging.debug("nbbd runs %s in %s", argv, repr(cwd))
+            from nbblib import main
+            main.cmdmain(argv)
+            code = 0
+        except SystemExit, e:
+            if isinstance(e.code, int):
+                code = e.code
+            elif e.code:
+                print >>sys.stderr, e.code
+        except KeyboardInterrupt:
+            code = 128 + signal.SIGTERM
+        except:
+            logging.error("nbbd command failed", exc_info=True)
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def _relay(conn, pid, out_r, err_r):
+    """Send the command's output over conn, then its exit code"""
+    kinds = {out_r: 'o', err_r: 'e'}
+    killed = False
+    while kinds:
+        try:
+            readable = select.select(kinds.keys() + [conn], [], [])[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if conn in readable and not killed:
+            # The client does not send anything after its request,
+            # so it has gone away (e.g. after Ctrl-C).
+            logging.debug("nbbd client gone, stopping command %d", pid)
+            os.kill(pid, signal.SIGTERM)
+            killed = True
+        for fd in readable:
+            if fd is conn:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                os.close(fd)
+                del kinds[fd]
+            elif not killed:
+                try:
+                    _send_frame(conn, kinds[fd], data)
+                except socket.error, e:
+                    logging.debug("Cannot send to nbbd client: %s", e)
+                    os.kill(pid, signal.SIGTERM)
+                    killed = True
+    status = os.waitpid(pid, 0)[1]
+    if os.WIFSIGNALED(status):
+        code = 128 + os.WTERMSIG(status)
+    else:
+        code = os.WEXITSTATUS(status)
+    if not killed:
+        _send_frame(conn, 'x', str(code))
+
+
+def _read_request(conn):
+    """Return the (version, argv, cwd, environ) request sent to conn"""
+    conn.settimeout(10)
+    try:
+        frame = _recv_frame(conn)
+    finally:
+        conn.settimeout(None)
+    if frame is None or frame[0] != 'q':
+        raise ValueError("Bad nbbd request")
+    return marshal.loads(frame[1])
+
+
+def _handle(listener, conn, request):
+    """In the forked process handling connection conn: never return"""
+    code = 0
+    try:
+        try:
+            listener.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            version, argv, cwd, env = request
+            if version != package.PACKAGE_VERSION:
+                _send_frame(conn, 'r', "nbbd is version %s"
+                            % package.PACKAGE_VERSION)
+                return
+            if argv is None:
+                _send_frame(conn, 'x', '0')
+                os.kill(os.getppid(), signal.SIGTERM)
+                return
+            out_r, out_w = os.pipe()
+            err_r, err_w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                conn.close()
+                os.close(out_r)
+                os.close(err_r)
+                _run_command(argv, cwd, env, out_w, err_w)
+            os.close(out_w)
+            os.close(err_w)
+            _relay(conn, pid, out_r, err_r)
+        except:
+            logging.error("nbbd connection failed", exc_info=True)
+            code = 1
+    finally:
+        try:
+            conn.close()
+        finally:
+            os._exit(code)
+
+
+def _reap():
+    while True:
+        try:
+            pid = os.waitpid(-1, os.WNOHANG)[0]
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.ECHILD:
+                raise
+            return
+        if pid == 0:
+            return
+
+
+__all__.append('serve')
+def serve(path):
+    """Run nbbd on socket path until stopped or nbblib changes"""
+    from nbblib import registry
+    registry.import_plugin_modules()
+    if os.path.exists(path):
+        if is_running(path):
+            raise DaemonRunning(path)
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    try:
+        listener.listen(16)
+        print "nbbd listening on %s" % path
+        sys.stdout.flush()
+        _serve_loop(listener)
+    finally:
+        listener.close()
+        try:
+            os.unlink(path)
+        except OSError, e:
+            logging.debug("Cannot remove %s: %s", repr(path), e)
+
+
+def _serve_loop(listener):
+    """Accept connections, forking a process for each"""
+    from nbblib import cache
+    libdir, fnames = _nbblib_files()
+    fp = cache.fingerprint((libdir, ), fnames)
+    try:
+        while True:
+            try:
+                readable = select.select([listener], [], [], 1.0)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            _reap()
+            if cache.fingerprint((libdir, ), fnames) != fp:
+                print "nbbd: nbblib in %s has changed, exiting" % libdir
+                break
+            if not readable:
+                continue
+            conn = listener.accept()[0]
+            try:
+                request = _read_request(conn)
+            except (socket.error, ValueError, EOFError, TypeError), e:
+                logging.debug("Ignoring nbbd connection: %s", e)
+                conn.close()
+                continue
+            if request[2]:
+                _warm(request[2])
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if os.fork() == 0:
+                _handle(listener, conn, request)
+            conn.close()
+    except KeyboardInterrupt:
+        # Ctrl-C, or SIGTERM e.g. from 'nbb daemon stop'
+        print "nbbd stopped"
+        # before serve() removes the socket 'nbb daemon stop' waits for
+        sys.stdout.flush()
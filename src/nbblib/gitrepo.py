@@ -0,0 +1,340 @@
+"""\
+nbblib.gitrepo - read git repository state without running git
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+Running git costs a fork and exec for every single question. For the
+few things nbb needs to know (is this a git work tree, where is its
+root, which branch is checked out, what are the nbb.* config values),
+reading a few small files is a lot cheaper.
+
+Whenever this module encounters something it does not fully understand
+(environment variables changing git's behaviour, config includes,
+unusual ref storage, repositories owned by other users, ...), it raises
+UnsupportedRepository, and the caller is expected to ask git itself.
+"""
+
+
+import os
+import logging
+
+
+__all__ = []
+
+
+__all__.append('UnsupportedRepository')
+class UnsupportedRepository(Exception):
+    """Raised when only git itself can reliably answer the question"""
+    def __init__(self, reason):
+        super(UnsupportedRepository, self).__init__()
+        self.reason = reason
+    def __str__(self):
+        return "Unsupported git repository: %s" % self.reason
+
+
+# Environment variables which change how git finds and reads a repository.
+UNSUPPORTED_ENV = ('GIT_DIR', 'GIT_WORK_TREE', 'GIT_COMMON_DIR',
+                   'GIT_CEILING_DIRECTORIES',
+                   'GIT_DISCOVERY_ACROSS_FILESYSTEM',
+                   'GIT_CONFIG', 'GIT_CONFIG_PARAMETERS', 'GIT_CONFIG_COUNT',
+                   )
+
+
+def _read_file(fname):
+    f = open(fname, 'r')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def _is_git_dir(gdir):
+    """Check whether gdir looks like a git directory, like git does"""
+    if not os.path.isfile(os.path.join(gdir, 'HEAD')):
+        return False
+    if os.path.isfile(os.path.join(gdir, 'commondir')):
+        return True
+    return (os.path.isdir(os.path.join(gdir, 'objects')) and
+            os.path.isdir(os.path.join(gdir, 'refs')))
+
+
+def _resolve_gitfile(fname):
+    """Return the git dir a '.git' file ('gitdir: <path>') points to"""
+    content = _read_file(fname).strip()
+    if not content.startswith('gitdir:'):
+        raise UnsupportedRepository("unknown .git file format in %s"
+                                    % repr(fname))
+    gdir = content[len('gitdir:'):].strip()
+    return os.path.normpath(os.path.join(os.path.dirname(fname), gdir))
+
+
+__all__.append('find_repository')
+def find_repository(path):
+    """Find the git work tree containing path
+
+    Returns a GitRepository, or None if path is not inside a git work
+    tree. Raises UnsupportedRepository if git itself needs to be asked.
+    """
+    for var in UNSUPPORTED_ENV:
+        if var in os.environ:
+            raise UnsupportedRepository("$%s is set" % var)
+    path = os.path.realpath(path)
+    curdir = path
+    dev = os.stat(curdir).st_dev
+    while True:
+        dotgit = os.path.join(curdir, '.git')
+        if os.path.isdir(dotgit):
+            gdir = dotgit
+        elif os.path.isfile(dotgit):
+            gdir = _resolve_gitfile(dotgit)
+        else:
+            gdir = None
+        if gdir and _is_git_dir(gdir):
+            if path == gdir or path.startswith(gdir + os.sep):
+                raise UnsupportedRepository("inside git dir %s" % repr(gdir))
+            if os.stat(curdir).st_uid != os.getuid():
+                # Let git decide about safe.directory
+                raise UnsupportedRepository("%s owned by other user"
+                                            % repr(curdir))
+            return GitRepository(curdir, gdir)
+        if _is_git_dir(curdir):
+            # Bare repository or inside some git dir
+            raise UnsupportedRepository("%s is a git dir" % repr(curdir))
+        parent = os.path.dirname(curdir)
+        if parent == curdir:
+            return None
+        if os.stat(parent).st_dev != dev:
+            # git does not cross file system boundaries by default
+            return None
+        curdir = parent
+
+
+def _parse_value(line, i, fname):
+    """Parse config value from line[i:], return (value, rest of line)"""
+    value = []
+    pending_space = ''
+    quoted = False
+    while i < len(line):
+        c = line[i]
+        i += 1
+        if c == '\n':
+            break
+        elif c == '\\':
+            if i >= len(line):
+                break
+            c = line[i]
+            i += 1
+            if c == '\n':
+                # line continuation, handled by the caller
+                return ''.join(value) + pending_space, None
+            elif c in 'ntb':
+                c = {'n': '\n', 't': '\t', 'b': '\b'}[c]
+            elif c not in '"\\':
+                raise UnsupportedRepository("bad escape in %s" % repr(fname))
+            value.append(pending_space)
+            pending_space = ''
+            value.append(c)
+        elif c == '"':
+            value.append(pending_space)
+            pending_space = ''
+            quoted = not quoted
+        elif c in ' \t' and not quoted:
+            if value:
+                pending_space += c
+        elif c in '#;' and not quoted:
+            break
+        else:
+            value.append(pending_space)
+            pending_space = ''
+            value.append(c)
+    if quoted:
+        raise UnsupportedRepository("unterminated quote in %s" % repr(fname))
+    return ''.join(value), ''
+
+
+__all__.append('parse_config')
+def parse_config(text, fname='<string>'):
+    """Parse git config file contents into a list of (key, value)
+
+    Section and variable names are lowercased, subsection names are
+    kept as they are. Variables without '=' get the value None.
+    """
+    items = []
+    section = None
+    lines = text.splitlines(True)
+    n = 0
+    while n < len(lines):
+        line = lines[n].lstrip()
+        n += 1
+        if not line or line[0] in '#;':
+            continue
+        if line[0] == '[':
+            end = line.find(']')
+            if end < 0:
+                raise UnsupportedRepository("bad section in %s" % repr(fname))
+            header = line[1:end].strip()
+            if ' ' in header or '\t' in header:
+                name, sub = header.split(None, 1)
+                if not (sub.startswith('"') and sub.endswith('"')):
+                    raise UnsupportedRepository("bad subsection in %s"
+                                                % repr(fname))
+                sub = sub[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+                section = "%s.%s" % (name.lower(), sub)
+            elif '.' in header:
+                name, sub = header.split('.', 1)
+                section = "%s.%s" % (name.lower(), sub.lower())
+            else:
+                section = header.lower()
+            if section.split('.')[0] in ('include', 'includeif'):
+                raise UnsupportedRepository("config includes in %s"
+                                            % repr(fname))
+            line = line[end+1:].lstrip()
+            if not line or line[0] in '#;':
+                continue
+        if section is None:
+            raise UnsupportedRepository("variable outside section in %s"
+                                        % repr(fname))
+        i = 0
+        while i < len(line) and (line[i].isalnum() or line[i] == '-'):
+            i += 1
+        name = line[:i].lower()
+        rest = line[i:].lstrip(' \t')
+        if not name:
+            raise UnsupportedRepository("bad variable in %s" % repr(fname))
+        if not rest or rest[0] in '\n#;':
+            items.append(("%s.%s" % (section, name), None))
+            continue
+        if rest[0] != '=':
+            raise UnsupportedRepository("bad variable in %s" % repr(fname))
+        value, tail = _parse_value(rest, 1, fname)
+        while tail is None and n < len(lines):
+            more, tail = _parse_value(lines[n], 0, fname)
+            n += 1
+            value += more
+        items.append(("%s.%s" % (section, name), value))
+    return items
+
+
+def _is_false(value):
+    """Interpret config value as boolean, like git does"""
+    if value is None:
+        return False
+    value = value.lower()
+    if value in ('false', 'no', 'off', '0', ''):
+        return True
+    elif value in ('true', 'yes', 'on', '1'):
+        return False
+    raise UnsupportedRepository("bad boolean value %s" % repr(value))
+
+
+def _global_config_files():
+    """Return list of system and global config files, as git reads them"""
+    files = []
+    if 'GIT_CONFIG_NOSYSTEM' not in os.environ:
+        files.append(os.environ.get('GIT_CONFIG_SYSTEM', '/etc/gitconfig'))
+    if 'GIT_CONFIG_GLOBAL' in os.environ:
+        files.append(os.environ['GIT_CONFIG_GLOBAL'])
+    else:
+        home = os.path.expanduser('~')
+        xdg_dir = os.environ.get('XDG_CONFIG_HOME')
+        if not xdg_dir:
+            xdg_dir = os.path.join(home, '.config')
+        files.append(os.path.join(xdg_dir, 'git', 'config'))
+        files.append(os.path.join(home, '.gitconfig'))
+    return files
+
+
+__all__.append('GitRepository')
+class GitRepository(object):
+    """Read-only view of a git work tree and its repository files"""
+
+    def __init__(self, work_tree, git_dir):
+        super(GitRepository, self).__init__()
+        self.work_tree = work_tree
+        self.git_dir = git_dir
+        commondir = os.path.join(git_dir, 'commondir')
+        if os.path.isfile(commondir):
+            # 'git worktree' checkout: config and refs are shared
+            self.common_dir = os.path.normpath(
+                os.path.join(git_dir, _read_file(commondir).strip()))
+        else:
+            self.common_dir = git_dir
+        self._config = None
+        self._head_ref = None
+
+    def _get_head_ref(self):
+        """Full name of the ref HEAD points to, or None if detached"""
+        if self._head_ref is None:
+            head = os.path.join(self.git_dir, 'HEAD')
+            if os.path.islink(head):
+                raise UnsupportedRepository("symlinked HEAD")
+            content = _read_file(head).strip()
+            if content.startswith('ref:'):
+                self._head_ref = content[len('ref:'):].strip()
+            else:
+                return None
+        return self._head_ref
+    head_ref = property(_get_head_ref)
+
+    def _load_config(self):
+        items = []
+        for fname in _global_config_files():
+            items.extend(self._read_config_file(fname))
+        local_items = self._read_config_file(os.path.join(self.common_dir,
+                                                          'config'))
+        items.extend(local_items)
+        local = dict(local_items)
+        if local.get('core.repositoryformatversion', '0') not in ('0', '1'):
+            raise UnsupportedRepository("unknown repository format")
+        if local.get('extensions.refstorage', 'files') != 'files':
+            raise UnsupportedRepository("unknown ref storage")
+        for key in ('core.worktree', 'core.bare', ):
+            if key in local and not _is_false(local[key]):
+                raise UnsupportedRepository("%s is set" % key)
+        if not _is_false(local.get('extensions.worktreeconfig', 'false')):
+            items.extend(self._read_config_file(
+                    os.path.join(self.git_dir, 'config.worktree')))
+        return items
+
+    def _read_config_file(self, fname):
+        try:
+            text = _read_file(fname)
+        except IOError:
+            return []
+        return parse_config(text, fname)
+
+    def _get_config(self):
+        """List of (key, value) from all config files, in git's order"""
+        if self._config is None:
+            self._config = self._load_config()
+            logging.debug("Read %d git config items for %s",
+                          len(self._config), repr(self.work_tree))
+        return self._config
+    config = property(_get_config)
+
+    def forget_config(self):
+        """Re-read the config files on next access"""
+        self._config = None
+
+    def config_get(self, key):
+        """Return last value of config key (like 'git config key') or None
+
+        Variables without value are returned as the empty string.
+        """
+        section, name = key.rsplit('.', 1)
+        if '.' in section:
+            name0, sub = section.split('.', 1)
+            key = "%s.%s.%s" % (name0.lower(), sub, name.lower())
+        else:
+            key = key.lower()
+        result = None
+        for ckey, cvalue in self.config:
+            if ckey == key:
+                if cvalue is None:
+                    result = ''
+                else:
+                    result = cvalue
+        return result
+
+    def __repr__(self):
+        return "<%s(%s, %s)>" % (self.__class__.__name__,
+                                 repr(self.work_tree), repr(self.git_dir))
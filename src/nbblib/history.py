@@ -0,0 +1,187 @@
+"""\
+nbblib.history - database of past nbb runs
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+Every nbb command, and every build stage it runs, is recorded in the
+SQLite database history.sqlite in the nbb cache directory: the source
+tree and branch, the command and stage, start time, duration, exit code
+and the peak RSS of the programs run (as reported by wait4()).
+
+The records are collected while nbb runs, and written in one go when
+the command has finished. Like the caches, the history is best effort:
+Without the sqlite3 module, or with an unwritable database, nothing is
+recorded.
+"""
+
+
+import os
+import math
+import time
+import logging
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from nbblib import cache
+
+
+__all__ = []
+
+
+__all__.append('HISTORY_FILE_NAME')
+HISTORY_FILE_NAME = 'history.sqlite'
+
+
+_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    tree_root TEXT,
+    branch TEXT,
+    command TEXT NOT NULL,
+    stage TEXT,
+    duration REAL NOT NULL,
+    exit_code INTEGER NOT NULL,
+    max_rss INTEGER
+)"""
+
+
+_COLUMNS = ('started', 'tree_root', 'branch', 'command', 'stage',
+            'duration', 'exit_code', 'max_rss', )
+
+
+__all__.append('Record')
+class Record(object):
+    """One recorded command or stage run (stage None for commands)"""
+
+    def __init__(self, started, tree_root, branch, command, stage,
+                 duration, exit_code, max_rss):
+        super(Record, self).__init__()
+        self.started = started
+        self.tree_root = tree_root
+        self.branch = branch
+        self.command = command
+        self.stage = stage
+        self.duration = duration
+        self.exit_code = exit_code
+        self.max_rss = max_rss
+
+    def values(self):
+        return tuple([ getattr(self, col) for col in _COLUMNS ])
+
+    def __repr__(self):
+        return "<%s%s>" % (self.__class__.__name__, repr(self.values()))
+
+
+__all__.append('History')
+class History(object):
+    """The history database"""
+
+    def __init__(self, filename=None):
+        super(History, self).__init__()
+        if not filename:
+            filename = os.path.join(cache.get_cache_dir(), HISTORY_FILE_NAME)
+        self.filename = filename
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, timeout=10)
+            self._conn.execute(_SCHEMA)
+        return self._conn
+
+    def add(self, records):
+        """Store a list of Records in one transaction"""
+        conn = self._connect()
+        conn.executemany("INSERT INTO runs (%s) VALUES (%s)"
+                         % (', '.join(_COLUMNS),
+                            ', '.join(['?'] * len(_COLUMNS))),
+                         [ rec.values() for rec in records ])
+        conn.commit()
+
+    def records(self, tree_root=None):
+        """Return list of Records, oldest first, for tree_root or all"""
+        query = "SELECT %s FROM runs" % ', '.join(_COLUMNS)
+        params = ()
+        if tree_root:
+            query += " WHERE tree_root = ?"
+            params = (tree_root, )
+        query += " ORDER BY started, id"
+        return [ Record(*row)
+                 for row in self._connect().execute(query, params) ]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+_pending = []
+_pending_lock = threading.Lock()
+
+
+__all__.append('branch_name')
+def branch_name(vcs_tree):
+    """Return vcs_tree's branch name, or None (e.g. for a detached HEAD)"""
+    try:
+        return vcs_tree.branch_name
+    except Exception, e:
+        logging.debug("No branch name for %s: %s", vcs_tree, e)
+        return None
+
+
+__all__.append('record')
+def record(context, tree_root, branch, stage, started, duration,
+           exit_code, max_rss):
+    """Remember a finished stage (or command, if stage is None)"""
+    if not context or not context.history or context.dry_run:
+        return
+    rec = Record(started, tree_root, branch, context.command, stage,
+                 duration, exit_code, max_rss)
+    _pending_lock.acquire()
+    try:
+        _pending.append(rec)
+    finally:
+        _pending_lock.release()
+
+
+__all__.append('flush')
+def flush():
+    """Write the records collected so far to the history database"""
+    _pending_lock.acquire()
+    try:
+        records = _pending[:]
+        del _pending[:]
+    finally:
+        _pending_lock.release()
+    if not records:
+        return
+    if sqlite3 is None:
+        logging.debug("No sqlite3 module, not recording build history")
+        return
+    try:
+        # Creating the cache directory may fail, too
+        history = History()
+        try:
+            history.add(records)
+        finally:
+            history.close()
+    except (sqlite3.Error, IOError, OSError), e:
+        logging.warning("Cannot record build history: %s", e)
+
+
+__all__.append('percentile')
+def percentile(values, pct):
+    """Return the pct percentile of sorted list values (nearest rank)"""
+    if not values:
+        return None
+    rank = int(math.ceil(len(values) * pct / 100.0))
+    return values[max(0, min(len(values), rank) - 1)]
+
+
+__all__.append('format_time')
+def format_time(started):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(started))
@@ -0,0 +1,141 @@
+"""\
+nbblib.jobserver - GNU make jobserver shared by all nbb runs on a host
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+The jobserver is a named FIFO in the nbb runtime directory, holding one
+byte for every job slot besides the one every make gets for free. The
+first nbb process to use it fills it with tokens for the configured
+budget. Other nbb processes, and the make processes they start, just
+take tokens out and put them back in. Thus all builds on the host
+together run at most about as many jobs as the budget, plus one for
+every top-level make.
+
+The tokens only live as long as some process keeps the FIFO open, so
+every nbb process using the jobserver holds it open, together with a
+shared lock on jobserver.lock. Whoever gets an exclusive lock on that
+file is the only user and (re-)initializes the tokens.
+
+The make processes find the jobserver via the file descriptors given in
+--jobserver-auth in $MAKEFLAGS. As make only cooperates through that,
+nbb takes tokens itself for programs like scons.
+"""
+
+
+import os
+import stat
+import fcntl
+import errno
+import logging
+
+
+__all__ = []
+
+
+__all__.append('get_runtime_dir')
+def get_runtime_dir():
+    """Return absolute path of (and create) the nbb runtime directory"""
+    xdg_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if xdg_dir:
+        rdir = os.path.join(xdg_dir, 'nbb')
+    else:
+        rdir = os.path.join('/tmp', 'nbb-%d' % os.getuid())
+    try:
+        os.makedirs(rdir, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(rdir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise RuntimeError("Unsafe nbb runtime directory %s" % repr(rdir))
+    return rdir
+
+
+__all__.append('JobServer')
+class JobServer(object):
+    """Handle on the host wide jobserver FIFO"""
+
+    def __init__(self, budget, rdir=None):
+        super(JobServer, self).__init__()
+        if not rdir:
+            rdir = get_runtime_dir()
+        self.budget = budget
+        self.path = os.path.join(rdir, 'jobserver')
+        self.lockpath = os.path.join(rdir, 'jobserver.lock')
+        self._lockfd = os.open(self.lockpath, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            os.mkfifo(self.path, 0600)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        if not stat.S_ISFIFO(os.lstat(self.path).st_mode):
+            raise RuntimeError("Not a FIFO: %s" % repr(self.path))
+        # O_RDWR never blocks on a FIFO, and keeps the tokens alive.
+        # make gets the blocking fd, nbb itself uses the non-blocking one.
+        self.fd = os.open(self.path, os.O_RDWR)
+        self._nbfd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            fcntl.flock(self._lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            logging.debug("Joining jobserver %s", repr(self.path))
+        else:
+            self._init_tokens()
+        fcntl.flock(self._lockfd, fcntl.LOCK_SH)
+
+    def _init_tokens(self):
+        """Replace whatever is in the FIFO with budget-1 tokens"""
+        self._take(1 << 16)
+        if self.budget > 1:
+            os.write(self._nbfd, '+' * (self.budget - 1))
+        logging.debug("Started jobserver %s with %d job slots",
+                      repr(self.path), self.budget)
+
+    def _take(self, count):
+        try:
+            return os.read(self._nbfd, count)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return ''
+
+    def acquire(self, count):
+        """Take up to count tokens without waiting, return them"""
+        if count < 1:
+            return ''
+        return self._take(count)
+
+    def release(self, tokens):
+        """Give back tokens taken by acquire()"""
+        if tokens:
+            os.write(self._nbfd, tokens)
+
+    def make_env_update(self):
+        """Return environment update making make use the jobserver"""
+        flags = "-j --jobserver-auth=%d,%d" % (self.fd, self.fd)
+        makeflags = os.environ.get('MAKEFLAGS')
+        if makeflags:
+            flags = "%s %s" % (flags, makeflags)
+        return {'MAKEFLAGS': flags}
+
+    def close(self):
+        for fd in (self.fd, self._nbfd, self._lockfd):
+            os.close(fd)
+
+    def __repr__(self):
+        return "<%s(%d, %s)>" % (self.__class__.__name__,
+                                 self.budget, repr(self.path))
+
+
+_jobserver = None
+
+
+__all__.append('get_jobserver')
+def get_jobserver(context):
+    """Return the JobServer to use with context, or None"""
+    global _jobserver
+    if not context or not context.jobserver or context.dry_run:
+        return None
+    if _jobserver is None:
+        _jobserver = JobServer(context.jobserver)
+    return _jobserver
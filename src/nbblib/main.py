@@ -25,10 +25,24 @@ Command line interface (implemeted):
     $ %(prog)s [general options] build [command specific options]
     $ %(prog)s [general options] install [command specific options]
 
+  Build several git branches at once, each in its own git worktree:
+    $ %(prog)s [general options] build-branches [-j <jobs>] <branch>...
+
+  Show statistics from the build history:
+    $ %(prog)s [general options] stats [--all]
+
+  Run many commands (from a file or stdin) in one nbb process:
+    $ %(prog)s [general options] batch [-j <jobs>] [-k] [<file>|-]
+
+  Run nbbd to answer nbb commands (with NBB_DAEMON=<socket> set):
+    $ %(prog)s [general options] daemon [--socket=<path>] [run|stop|status]
+
   Get/set config:
     $ %(prog)s [general options] config srcdir
     $ %(prog)s [general options] config builddir [<builddir>]
     $ %(prog)s [general options] config installdir [<installdir>]
+    $ %(prog)s [general options] config jobs [<jobs>|auto]
+    $ %(prog)s [general options] config ccache [on|off|<max-size>]
 
   Start an interactive shell in either of the three directories:
     $ %(prog)s [general options] sh --srcdir [command specific options]
@@ -57,6 +71,27 @@ Global options:
   -V --version       Print program version number
 
   -n --dry-run       Do not actually execute any commands
+  -f --force         Run build stages even if they are up to date
+  -q --quiet         Show only a progress line instead of the output of
+                     build stages (which is in nbb-<stage>.log in the
+                     builddir either way)
+  --no-detect-cache  Ignore and do not update cached detection results
+  --no-config-cache  Do not share autoconf's config.cache between builddirs
+  --artifact-cache   Restore installdir from the artifact cache when the
+                     same sources have been installed there before
+  --no-history       Do not record this run in the build history
+  --parallel-detect  Probe all VCS and BS plugins concurrently
+  --jobserver[=N]    Share N (default: number of CPUs) make job slots
+                     with all other nbb runs using --jobserver
+  --timeout=SECS     Kill build stage programs running longer than SECS
+  --stall-timeout=SECS
+                     Kill build stage programs which have not written
+                     any output for SECS
+  --trace=FILE       Write timings of programs run and of nbb's phases
+                     to FILE (in Chrome trace event format)
+
+  --profile[=FILE]   Profile nbb itself, writing pstats data to FILE
+                     (default: nbb.prof) and a summary to stderr
 
   -b --build-system  Force buildsystem detection (%(buildsystems)s)
   -v --vcs           Force VCS detection (%(vcssystems)s)
@@ -64,15 +99,17 @@ Global options:
 
 
 import sys
+import time
+import signal
 import logging
 
 
-from nbblib import bs
 from nbblib import commands
 from nbblib import package
 from nbblib import plugins
-from nbblib import vcs
+from nbblib import registry
 from nbblib import progutils
+from nbblib import trace
 
 
 def print_version(context):
@@ -149,12 +186,12 @@ class ProgProperty(Property):
 
 class VCSProperty(Property):
     def isvalid(self, value):
-        return (value in vcs.VCSourceTree.plugins.keys())
+        return (value in registry.plugin_names(registry.VCS))
 
 
 class BSProperty(Property):
     def isvalid(self, value):
-        return (value in bs.BSSourceTree.plugins.keys())
+        return (value in registry.plugin_names(registry.BS))
 
 
 class BoolProperty(Property):
@@ -169,12 +206,70 @@ class DryRunProperty(BoolProperty):
         super(DryRunProperty, self).__init__(default=False)
 
 
+class QuietProperty(BoolProperty):
+    def __init__(self):
+        super(QuietProperty, self).__init__(default=False)
+
+
+class DetectCacheProperty(BoolProperty):
+    def __init__(self):
+        super(DetectCacheProperty, self).__init__(default=True)
+
+
+class ConfigCacheProperty(BoolProperty):
+    def __init__(self):
+        super(ConfigCacheProperty, self).__init__(default=True)
+
+
+class ArtifactCacheProperty(BoolProperty):
+    def __init__(self):
+        super(ArtifactCacheProperty, self).__init__(default=False)
+
+
+class HistoryProperty(BoolProperty):
+    def __init__(self):
+        super(HistoryProperty, self).__init__(default=True)
+
+
+class ParallelDetectProperty(BoolProperty):
+    def __init__(self):
+        super(ParallelDetectProperty, self).__init__(default=False)
+
+
+class ForceProperty(BoolProperty):
+    def __init__(self):
+        super(ForceProperty, self).__init__(default=False)
+
+
+class JobServerProperty(Property):
+    def isvalid(self, value):
+        return (value is None) or (isinstance(value, int) and value > 0)
+
+
+class SecondsProperty(Property):
+    def isvalid(self, value):
+        return (value is None) or (isinstance(value, int) and value > 0)
+
+
 class Context(object):
     PACKAGE_VERSION = Property()
     prog = ProgProperty()
+    argv0 = Property()
+    global_args = Property()
     vcs = VCSProperty()
     bs = BSProperty()
     dry_run = DryRunProperty()
+    quiet = QuietProperty()
+    detect_cache = DetectCacheProperty()
+    config_cache = ConfigCacheProperty()
+    artifact_cache = ArtifactCacheProperty()
+    history = HistoryProperty()
+    command = Property()
+    parallel_detect = ParallelDetectProperty()
+    jobserver = JobServerProperty()
+    force = ForceProperty()
+    timeout = SecondsProperty()
+    stall_timeout = SecondsProperty()
     vcssystems = Property()
     buildsystems = Property()
 
@@ -198,12 +293,25 @@ class Context(object):
         return "%s(%s)" % (self.__class__.__name__, ", ".join(it))
 
 
+def parse_seconds(option, value):
+    try:
+        seconds = int(value)
+    except ValueError:
+        seconds = 0
+    if seconds < 1:
+        raise commands.CommandLineError(\
+            'Invalid number of seconds for %s: %s' % (option, repr(value)))
+    return seconds
+
+
 def main(argv):
+    registry.load_plugins()
     context = Context()
     context.PACKAGE_VERSION = package.PACKAGE_VERSION
-    context.vcssystems = ", ".join(vcs.VCSourceTree.plugins.keys())
-    context.buildsystems = ", ".join(bs.BSSourceTree.plugins.keys())
+    context.vcssystems = ", ".join(registry.plugin_names(registry.VCS))
+    context.buildsystems = ", ".join(registry.plugin_names(registry.BS))
     context.prog = argv[0]
+    context.argv0 = argv[0]
 
     if len(argv) < 2:
         raise commands.CommandLineError(\
@@ -221,6 +329,41 @@ def main(argv):
             return
         elif argv[i] in ('-n', '--dry-run'):
             context.dry_run = True
+        elif argv[i] in ('-q', '--quiet'):
+            context.quiet = True
+        elif argv[i] in ('--no-detect-cache', ):
+            context.detect_cache = False
+        elif argv[i] in ('--no-config-cache', ):
+            context.config_cache = False
+        elif argv[i] in ('--artifact-cache', ):
+            context.artifact_cache = True
+        elif argv[i] in ('--no-history', ):
+            context.history = False
+        elif argv[i] in ('--parallel-detect', ):
+            context.parallel_detect = True
+        elif argv[i] in ('-f', '--force'):
+            context.force = True
+        elif argv[i] in ('--jobserver', ):
+            context.jobserver = progutils.cpu_count()
+        elif argv[i][:12] == '--jobserver=':
+            try:
+                budget = int(argv[i][12:])
+            except ValueError:
+                budget = 0
+            if budget < 1:
+                raise commands.CommandLineError(\
+                    'Invalid jobserver budget %s' % repr(argv[i][12:]))
+            context.jobserver = budget
+        elif argv[i][:10] == '--timeout=':
+            context.timeout = parse_seconds('--timeout', argv[i][10:])
+        elif argv[i][:16] == '--stall-timeout=':
+            context.stall_timeout = parse_seconds('--stall-timeout',
+                                                  argv[i][16:])
+        elif argv[i][:8] == '--trace=':
+            if not argv[i][8:]:
+                raise commands.CommandLineError(\
+                    'Option --trace requires a file name')
+            trace.enable(argv[i][8:])
         elif argv[i] in ('-b', '--build-system'):
             i = i + 1
             assert(i < len(argv))
@@ -240,46 +383,91 @@ def main(argv):
                 'Unknown global option %s' % repr(argv[i]))
         i = i + 1
 
+    context.global_args = argv[1:i]
     logging.info("Context: %s", context)
     cmd = argv[i]
     cmdargs = argv[i+1:]
 
-    cdr = commands.Commander(context, cmd, *cmdargs)
-    cdr.run()
+    context.command = cmd
+    # Programs of earlier commands (e.g. in a Session) do not count
+    progutils.reset_max_rss(all_threads=True)
+    span = trace.Span(cmd, 'command', {'args': cmdargs})
+    cdr = None
+    code = 1
+    try:
+        try:
+            cdr = commands.Commander(context, cmd, *cmdargs)
+            cdr.run()
+            code = 0
+        except Exception, e:
+            code = exit_code(e) or 1
+            raise
+    finally:
+        span.end()
+        record_command(context, cdr, span.start, code)
+        trace.write()
+
+
+def record_command(context, cdr, started, code):
+    """Add the command run to the build history"""
+    # Imported here, as sqlite3 and nbblib.cache take a while to load
+    from nbblib import history
+    tree_root = branch = None
+    vcs_tree = getattr(cdr and cdr.command, 'vcs_sourcetree', None)
+    if vcs_tree:
+        tree_root = vcs_tree.tree_root
+        branch = history.branch_name(vcs_tree)
+    max_rss = progutils.get_max_rss(all_threads=True)
+    history.record(context, tree_root, branch, None, started,
+                   time.time() - started, code, max_rss)
+    history.flush()
+
+
+"""Exit codes for the exceptions cmdmain() reports"""
+EXIT_CODES = ((commands.CommandLineError, 2),
+              (commands.UnknownCommand, 2),
+              (plugins.PluginNoMatch, 1),
+              (plugins.AmbigousPluginDetection, 1),
+              (RuntimeError, 1),
+              (progutils.ProgramRunError, 3),
+              )
+
+
+def exit_code(e):
+    """Return exit code for exception e, or None if cmdmain() passes it on"""
+    for cls, code in EXIT_CODES:
+        if isinstance(e, cls):
+            return code
+    return None
+
+
+def terminate(signum, frame):
+    """SIGTERM handler: Clean up like after Ctrl-C"""
+    raise KeyboardInterrupt("Terminated by signal %d" % signum)
 
 
 def cmdmain(argv):
+    signal.signal(signal.SIGTERM, terminate)
     try:
         main(argv)
         logging.shutdown()
-    except commands.CommandLineError, e:
-        logging.error(e)
+    except KeyboardInterrupt:
+        # Build programs run in process groups of their own, so they
+        # do not get the signal from the terminal.
+        progutils.kill_children()
         logging.shutdown()
-        sys.exit(2)
-    except commands.UnknownCommand, e:
-        logging.error(e)
-        logging.shutdown()
-        sys.exit(2)
-    except plugins.PluginNoMatch, e:
-        logging.error(e)
-        logging.shutdown()
-        sys.exit(1)
-    except plugins.AmbigousPluginDetection, e:
-        logging.error(e)
-        logging.shutdown()
-        sys.exit(1)
-    except RuntimeError, e:
-        logging.error(e)
-        logging.shutdown()
-        sys.exit(1)
-    except progutils.ProgramRunError, e:
-        logging.error(e)
-        logging.shutdown()
-        sys.exit(3)
+        raise
     except SystemExit, e:
         logging.error("Someone called sys.exit() who should not have", exc_info=e)
         logging.shutdown()
         raise
+    except Exception, e:
+        code = exit_code(e)
+        if code is None:
+            raise
+        logging.error(e)
+        logging.shutdown()
+        sys.exit(code)
 
 
 __all__ = ['cmdmain', 'main']
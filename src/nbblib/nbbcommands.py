@@ -4,10 +4,13 @@ Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
 """
 
 import os
+import sys
+import fnmatch
 import logging
 
 
 import nbblib.progutils as progutils
+import nbblib.plugins as plugins
 import nbblib.vcs as vcs
 import nbblib.bs as bs
 
@@ -166,13 +169,385 @@ class BuildTestCommand(SourceClassCommand):
     name = 'build-test'
     summary = 'simple build test'
     def run(self):
-        self.bs_sourcetree.init()
-        self.bs_sourcetree.configure()
-        self.bs_sourcetree.build()
-        self.bs_sourcetree.install()
+        self.bs_sourcetree.build_test()
     validate_args = Command.validate_args_none
 
 
+class BuildBranchesCommand(SourceClassCommand):
+    """\
+    Run a build test (e.g. init, configure, build, check, install) for
+    each given git branch, with up to <jobs> (default: number of CPUs)
+    branches being built at the same time. <branch> may be a shell
+    pattern matching local branch names.
+
+    Every branch is built in its own git worktree (an existing one, or
+    a new one in _worktree/<branch>), and thus with that worktree's
+    builddir and installdir. The output of every branch build goes to
+    _worktree/<branch>.log.
+    """
+
+    name = 'build-branches'
+    summary = 'build test several git branches in parallel'
+    usage = '[-j <jobs>] <branch>...'
+
+    def validate_args(self, *args, **kwargs):
+        args = list(args)
+        if args and args[0] == '-j':
+            if len(args) < 2:
+                raise CommandLineError("'%s' option -j requires a parameter"
+                                       % self.name)
+            args = args[2:]
+        elif args and args[0].startswith('-j'):
+            args = args[1:]
+        if not args:
+            raise CommandLineError("'%s' command requires at least one branch"
+                                   % self.name)
+
+    def __init__(self, context, *args, **kwargs):
+        super(BuildBranchesCommand, self).__init__(context, *args, **kwargs)
+        self.jobs = progutils.cpu_count()
+        self.patterns = list(self.args)
+        if self.patterns[0] == '-j':
+            jobs = self.patterns[1]
+            self.patterns = self.patterns[2:]
+        elif self.patterns[0].startswith('-j'):
+            jobs = self.patterns[0][2:]
+            self.patterns = self.patterns[1:]
+        else:
+            jobs = None
+        if jobs is not None:
+            try:
+                self.jobs = int(jobs)
+            except ValueError:
+                self.jobs = 0
+            if self.jobs < 1:
+                raise CommandLineError("'%s' invalid number of jobs %s"
+                                       % (self.name, repr(jobs)))
+        if not isinstance(self.vcs_sourcetree, vcs.GitSourceTree):
+            raise RuntimeError("'%s' command requires a git source tree"
+                               % self.name)
+
+    def select_branches(self):
+        """Return branch names matching the patterns, in pattern order"""
+        local_branches = self.vcs_sourcetree.local_branches()
+        branches = []
+        for pattern in self.patterns:
+            matches = fnmatch.filter(local_branches, pattern)
+            if not matches:
+                raise RuntimeError("No branch matching %s" % repr(pattern))
+            for branch in matches:
+                if branch not in branches:
+                    branches.append(branch)
+        return branches
+
+    def run(self):
+        tree_root = self.vcs_sourcetree.tree_root
+        wt_top = os.path.join(tree_root, '_worktree')
+        worktrees = self.vcs_sourcetree.worktrees()
+        prog = self.context.argv0
+        if os.sep in prog:
+            prog = os.path.abspath(prog)
+        # The branch builds must not all write the same trace file
+        global_args = [ arg for arg in self.context.global_args
+                        if not arg.startswith('--trace=') ]
+        call_list = [prog] + global_args + ['build-test']
+        jobs = []
+        for branch in self.select_branches():
+            if branch in worktrees:
+                wtdir = worktrees[branch]
+            else:
+                wtdir = os.path.join(wt_top, branch)
+                self.vcs_sourcetree.add_worktree(wtdir, branch)
+            logfile = os.path.join(wt_top, "%s.log" % branch)
+            if not self.context.dry_run:
+                logdir = os.path.dirname(logfile)
+                if not os.path.exists(logdir):
+                    os.makedirs(logdir)
+            jobs.append((branch, call_list, wtdir, logfile))
+        results = progutils.prog_run_parallel(jobs, self.jobs, self.context)
+        print "Branch build summary:"
+        width = max([ len(job[0]) for job in jobs ])
+        failed = 0
+        for branch, call_list, wtdir, logfile in jobs:
+            retcode, duration = results[branch]
+            if retcode == 0:
+                status = "ok"
+            else:
+                status = "FAILED (retcode %d)" % retcode
+                failed += 1
+            print "  %-*s  %-20s %7.1fs  %s" % (width, branch, status,
+                                                duration, logfile)
+        if failed:
+            raise RuntimeError("%d of %d branch builds failed"
+                               % (failed, len(jobs)))
+
+
+class StatsCommand(Command):
+    """\
+    Show statistics from the build history of the source tree the
+    current directory is in, or of all source trees with --all (or
+    when not in a source tree):
+
+      * duration percentiles, failures and peak RSS per stage
+      * duration percentiles of the commands per branch
+      * the slowest stage runs
+      * per stage, the median duration of the older and the newer
+        half of the runs (i.e. whether builds become slower)
+    """
+
+    name = 'stats'
+    summary = 'show statistics from the build history'
+    usage = '[--all]'
+
+    def validate_args(self, *args, **kwargs):
+        if args and list(args) != ['--all']:
+            raise CommandLineError("'%s' command only takes an optional --all"
+                                   % self.name)
+
+    def __init__(self, context, *args, **kwargs):
+        super(StatsCommand, self).__init__(context, *args, **kwargs)
+        self.vcs_sourcetree = None
+        self.tree_root = None
+        if '--all' not in args:
+            try:
+                self.vcs_sourcetree = vcs.VCSourceTree.detect(context,
+                                                              os.getcwd())
+                self.tree_root = self.vcs_sourcetree.tree_root
+            except plugins.PluginNoMatch, e:
+                logging.debug("Showing stats for all source trees: %s", e)
+
+    def _print_table(self, title, groups):
+        """Print duration stats for dict mapping names to record lists"""
+        from nbblib import history
+        print title
+        print "  %-20s %5s %5s %8s %8s %8s %10s" % ('', 'runs', 'fails',
+                                                   'p50', 'p90', 'max',
+                                                   'peak RSS')
+        names = groups.keys()
+        names.sort()
+        for name in names:
+            records = groups[name]
+            durations = [ rec.duration for rec in records ]
+            durations.sort()
+            fails = len([ rec for rec in records if rec.exit_code != 0 ])
+            max_rss = max([ rec.max_rss or 0 for rec in records ])
+            print "  %-20s %5d %5d %7.1fs %7.1fs %7.1fs %8.1fMB" % \
+                (name, len(records), fails,
+                 history.percentile(durations, 50),
+                 history.percentile(durations, 90),
+                 durations[-1], max_rss / 1024.0)
+
+    def run(self):
+        from nbblib import history
+        if history.sqlite3 is None:
+            raise RuntimeError("Build history requires the sqlite3 module")
+        db = history.History()
+        try:
+            records = db.records(self.tree_root)
+        finally:
+            db.close()
+        if self.tree_root:
+            where = repr(self.tree_root)
+        else:
+            where = "all source trees"
+        if not records:
+            print "No build history for %s" % where
+            return
+        print "Build history for %s: %d records since %s" % \
+            (where, len(records), history.format_time(records[0].started))
+        stages = {}
+        branches = {}
+        for rec in records:
+            if rec.stage:
+                stages.setdefault(rec.stage, []).append(rec)
+            else:
+                branches.setdefault(rec.branch or '(none)', []).append(rec)
+        print
+        self._print_table("Stages:", stages)
+        print
+        self._print_table("Commands per branch:", branches)
+        print
+        print "Slowest stage runs:"
+        slowest = [ (rec.duration, rec) for rec in records if rec.stage ]
+        slowest.sort()
+        slowest.reverse()
+        for duration, rec in slowest[:5]:
+            print "  %7.1fs  %-12s %-20s %s" % (duration, rec.stage,
+                                              rec.branch or '(none)',
+                                              history.format_time(rec.started))
+        print
+        print "Trend (median duration, older vs newer half of runs):"
+        names = stages.keys()
+        names.sort()
+        for name in names:
+            durations = [ rec.duration for rec in stages[name] ]
+            if len(durations) < 2:
+                continue
+            half = len(durations) / 2
+            older = durations[:half]
+            newer = durations[half:]
+            older.sort()
+            newer.sort()
+            before = history.percentile(older, 50)
+            after = history.percentile(newer, 50)
+            if before > 0:
+                change = "%+.0f%%" % (100.0 * (after - before) / before)
+            else:
+                change = "n/a"
+            print "  %-20s %7.1fs -> %7.1fs  %s" % (name, before, after, change)
+
+
+class DaemonCommand(Command):
+    """\
+    Run nbbd, which answers nbb commands without starting python and
+    detecting the source tree anew every time, until stopped with
+    'daemon stop'. nbb sends its commands to nbbd when the NBB_DAEMON
+    environment variable is set to the socket nbbd listens on (default:
+    nbbd.sock in the nbb cache directory), and runs them itself when
+    no nbbd is running there.
+
+    Commands run by nbbd cannot read from the terminal.
+    """
+
+    name = 'daemon'
+    summary = 'run nbbd to answer nbb commands faster'
+    usage = '[--socket=<path>] [run|stop|status]'
+
+    def validate_args(self, *args, **kwargs):
+        args = [ arg for arg in args if not arg.startswith('--socket=') ]
+        if len(args) > 1 or (args and args[0] not in ('run', 'stop',
+                                                     'status')):
+            raise CommandLineError("'%s' command takes an optional "
+                                   "run, stop or status" % self.name)
+
+    def __init__(self, context, *args, **kwargs):
+        super(DaemonCommand, self).__init__(context, *args, **kwargs)
+        self.socket = None
+        self.action = 'run'
+        for arg in args:
+            if arg.startswith('--socket='):
+                self.socket = os.path.abspath(arg[len('--socket='):])
+            else:
+                self.action = arg
+        if not self.socket:
+            from nbblib import daemon
+            self.socket = daemon.default_socket()
+
+    def run(self):
+        from nbblib import daemon
+        if self.action == 'run':
+            daemon.serve(self.socket)
+        elif self.action == 'stop':
+            if not daemon.stop(self.socket):
+                raise RuntimeError("nbbd is not running on %s"
+                                   % repr(self.socket))
+        elif daemon.is_running(self.socket):
+            print "nbbd is running on %s" % self.socket
+        else:
+            raise RuntimeError("nbbd is not running on %s"
+                               % repr(self.socket))
+
+
+class BatchCommand(Command):
+    """\
+    Run the nbb commands listed in <file> (or on stdin, without <file>
+    or with '-'), all in this one nbb process, so that python starts
+    and the source trees are examined just once. Every line holds one
+    command line (without 'nbb'), quoted like for the shell, and 'cd
+    <dir>' lines set the directory the following commands run in.
+    The global options given to 'batch' apply to all commands.
+
+    After a command has failed, the following commands are not run,
+    unless -k is given. With -j <jobs>, the commands for up to <jobs>
+    source trees run at the same time, each tree's commands one after
+    the other; their output is shown when they are done.
+    """
+
+    name = 'batch'
+    summary = 'run many nbb commands in one process'
+    usage = '[-j <jobs>] [-k] [<file>|-]'
+
+    def _parse_args(self, args):
+        """Return (jobs, keep_going, filename) from args"""
+        jobs = 1
+        keep_going = False
+        args = list(args)
+        while args and args[0][:1] == '-' and args[0] != '-':
+            if args[0] == '-k':
+                keep_going = True
+                args = args[1:]
+                continue
+            if args[0] == '-j':
+                if len(args) < 2:
+                    raise CommandLineError("'%s' option -j requires "
+                                           "a parameter" % self.name)
+                value = args[1]
+                args = args[2:]
+            elif args[0].startswith('-j'):
+                value = args[0][2:]
+                args = args[1:]
+            else:
+                raise CommandLineError("'%s' unknown option %s"
+                                       % (self.name, repr(args[0])))
+            try:
+                jobs = int(value)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                raise CommandLineError("'%s' invalid number of jobs %s"
+                                       % (self.name, repr(value)))
+        if len(args) > 1:
+            raise CommandLineError("'%s' command takes at most one file"
+                                   % self.name)
+        return jobs, keep_going, (args + ['-'])[0]
+
+    def validate_args(self, *args, **kwargs):
+        self._parse_args(args)
+
+    def __init__(self, context, *args, **kwargs):
+        super(BatchCommand, self).__init__(context, *args, **kwargs)
+        self.jobs, self.keep_going, self.filename = self._parse_args(args)
+
+    def read_commands(self):
+        """Return list of (cwd, args) from the batch file"""
+        try:
+            if self.filename == '-':
+                lines = sys.stdin.readlines()
+                filename = '<stdin>'
+            else:
+                f = open(self.filename, 'r')
+                try:
+                    lines = f.readlines()
+                finally:
+                    f.close()
+                filename = self.filename
+        except IOError, e:
+            raise RuntimeError("Cannot read batch file %s: %s"
+                               % (repr(self.filename), e))
+        from nbblib import session
+        return session.parse_batch(lines, os.getcwd(), filename)
+
+    def run(self):
+        from nbblib import session
+        cmds = self.read_commands()
+        # The commands must not all write the same trace file
+        global_args = [ arg for arg in self.context.global_args
+                        if not arg.startswith('--trace=') ]
+        sess = session.Session(global_args, self.context.argv0)
+        codes = sess.run_many(cmds, self.jobs, self.keep_going)
+        failed = [ i for i in range(len(cmds)) if codes[i] ]
+        skipped = [ i for i in range(len(cmds)) if codes[i] is None ]
+        print "Batch summary: %d commands, %d failed, %d not run" % \
+            (len(cmds), len(failed), len(skipped))
+        for i in failed:
+            cwd, args = cmds[i]
+            print "  FAILED (retcode %d): %s" % (codes[i], ' '.join(args))
+            print "    in", cwd
+        if failed or skipped:
+            raise RuntimeError("%d of %d batch commands failed"
+                               % (len(failed), len(cmds)))
+
+
 class InitCommand(SourceClassCommand):
     name = 'init'
     summary = 'initialize buildsystem (e.g. "autoreconf")'
@@ -213,9 +588,14 @@ class MakeCommand(SourceClassCommand):
         if hasattr(self.bs_sourcetree, 'make'):
             self.bs_sourcetree.make(*self.args)
         else:
+            from nbblib import jobserver
             os.chdir(self.bs_sourcetree.config.builddir)
-            progutils.prog_run(["make"] + list(self.args),
-                               self.context)
+            js = jobserver.get_jobserver(self.context)
+            progutils.prog_run(["make"] +
+                               bs.make_job_args(self.bs_sourcetree.config,
+                                                self.args, js) +
+                               list(self.args),
+                               self.context, jobserver=js)
 
 
 class GeneralRunCommand(SourceClassCommand):
@@ -288,42 +668,58 @@ class InstallShellCommand(GeneralShellCommand):
 class ConfigCommand(SourceClassCommand):
     name = 'config'
     summary = 'set/get config values'
-    usage = '(srcdir|builddir|installdir)'
+    usage = '(srcdir|builddir|installdir|jobs|ccache) [<value>] [<item> <value>...]'
 
     def validate_args(self, *args, **kwargs):
-        items = ('srcdir', 'builddir', 'installdir', )
+        items = ('srcdir', 'builddir', 'installdir', 'jobs', 'ccache', )
         if len(args) == 0:
             raise CommandLineError("'%s' command requires at least one parameter (%s)"
                                    % (self.name, ', '.join(items)))
         elif len(args) == 1 and args[0] in items:
             pass
-        elif len(args) == 2 and args[0] in items:
-            if args[0] in ('srcdir', ):
-                raise CommandLineError("'%s' command cannot change 'srcdir'"
-                                       % self.name)
-            else:
-                pass
+        elif len(args) % 2 == 0:
+            for item in args[::2]:
+                if item in ('srcdir', ):
+                    raise CommandLineError("'%s' command cannot change 'srcdir'"
+                                           % self.name)
+                elif item not in items:
+                    raise CommandLineError("'%s' command cannot set %s"
+                                           % (self.name, repr(item)))
+            for item, value in zip(args[::2], args[1::2]):
+                if item == 'jobs' and value != 'auto' and \
+                        not (value.isdigit() and int(value) > 0):
+                    raise CommandLineError("'%s' command: invalid jobs value %s"
+                                           % (self.name, repr(value)))
+                if item == 'ccache' and not vcs.valid_ccache_value(value):
+                    raise CommandLineError("'%s' command: invalid ccache value %s"
+                                           % (self.name, repr(value)))
         else:
             raise CommandLineError("'%s' requires less or different parameters"
                                    % self.name)
 
     def run(self):
         git_get_items = ('builddir', 'installdir', 'srcdir')
-        git_set_items = ('builddir', 'installdir', )
         if len(self.args) == 1:
             if self.args[0] in git_get_items:
                 print getattr(self.vcs_sourcetree.config, self.args[0])
-            else:
-                assert(False)
-        elif len(self.args) == 2 and self.args[0] in git_set_items:
-            if self.args[0] == 'builddir':
-                self.vcs_sourcetree.config.builddir = self.args[1]
-            elif self.args[0] == 'installdir':
-                self.vcs_sourcetree.config.installdir = self.args[1]
+            elif self.args[0] == 'jobs':
+                jobs = self.vcs_sourcetree.config.jobs
+                if jobs is None:
+                    print 'auto'
+                else:
+                    print jobs
+            elif self.args[0] == 'ccache':
+                ccache = self.vcs_sourcetree.config.ccache
+                if ccache is None:
+                    print 'off'
+                else:
+                    print ccache
             else:
                 assert(False)
         else:
-            assert(False)
+            # Set all items in one go
+            items = dict(zip(self.args[::2], self.args[1::2]))
+            self.vcs_sourcetree.config.set_items(items)
 
 
 # End of file.
@@ -65,14 +65,22 @@ class MyPluginB(MyPluginType):
 #     and fails if one is found
 
 
+import sys
+import Queue
 import logging
 import functools
-import inspect
+import threading
+
+from nbblib import trace
 
 
 __all__ = []
 
 
+"""Maximum number of plugins probed at the same time by parallel detect()"""
+DETECT_THREADS = 8
+
+
 __all__.append('NoPluginsRegistered')
 class NoPluginsRegistered(Exception):
     """Raised when looking for plugins but none are registered"""
@@ -181,25 +189,152 @@ def abstractmethod(fun):
     return wrapper
 
 
+__all__.append('LazyPlugin')
+class LazyPlugin(object):
+    """Placeholder for a plugin class known from a manifest, but not imported
+
+    attrs contains a few class attributes (like summary) which can be
+    queried without importing the plugin's module.
+    """
+    def __init__(self, module, classname, attrs):
+        super(LazyPlugin, self).__init__()
+        self.module = module
+        self.classname = classname
+        self.attrs = attrs
+    def load(self):
+        """Import the plugin module and return the plugin class"""
+        logging.debug("Loading plugin %s.%s", self.module, self.classname)
+        __import__(self.module)
+        return getattr(sys.modules[self.module], self.classname)
+    def __str__(self):
+        return "<lazy plugin %s.%s>" % (self.module, self.classname)
+    __repr__ = __str__
+
+
 # Internal type __all__.append('PluginDict')
 class PluginDict(dict):
     """Helper for GenericPluginMeta class
 
     Behaves basically like a standard dict, but will raise an exception
     when asked to update an existing value.
+
+    Values may also be LazyPlugin placeholders. They are replaced by the
+    real plugin class when it registers itself, and looking them up
+    imports the plugin module. Use peek() to read the attributes recorded
+    in the manifest without importing anything.
     """
 
     # This is the important difference between PluginDict and dict.
     def __setitem__(self, key, value):
         if (key in self):
-            old = self[key]
-            if old.__name__ == value.__name__ and old.__module__ == value.__module__:
+            old = dict.__getitem__(self, key)
+            if isinstance(old, LazyPlugin):
+                super(PluginDict, self).__setitem__(key, value)
+            elif old.__name__ == value.__name__ and old.__module__ == value.__module__:
                 pass
             else:
-                raise DuplicatePluginName(name=key, old=self[key], new=value)
+                raise DuplicatePluginName(name=key, old=old, new=value)
         else:
             super(PluginDict, self).__setitem__(key, value)
 
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, LazyPlugin):
+            klass = value.load()
+            if dict.__getitem__(self, key) is value:
+                # Stale manifest: The class does not register under key.
+                super(PluginDict, self).__setitem__(key, klass)
+            return klass
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def peek(self, key, attr, default=None):
+        """Return class attribute attr of plugin key, avoiding imports"""
+        value = dict.__getitem__(self, key)
+        if isinstance(value, LazyPlugin):
+            return value.attrs.get(attr, default)
+        return getattr(value, attr, default)
+
+    def add_lazy(self, key, module, classname, attrs):
+        """Add LazyPlugin placeholder unless key is registered already"""
+        if key not in self:
+            super(PluginDict, self).__setitem__(key, LazyPlugin(module,
+                                                                classname,
+                                                                attrs))
+
+
+# Mount point id (module.classname) -> mount point class
+_mount_points = {}
+# Mount point id -> {plugin name -> (module, classname, attrs)}
+_manifest = {}
+
+
+__all__.append('mount_point_id')
+def mount_point_id(cls):
+    """Return string identifying the plugin mount point class cls"""
+    return "%s.%s" % (cls.__module__, cls.__name__)
+
+
+__all__.append('register_manifest')
+def register_manifest(manifest):
+    """Make plugins known from manifest without importing their modules
+
+    manifest maps mount point ids to dicts which map plugin names
+    to (module, classname, attrs) tuples.
+    """
+    for mpid, entries in manifest.iteritems():
+        _manifest.setdefault(mpid, {}).update(entries)
+        if mpid in _mount_points:
+            _add_manifest_entries(_mount_points[mpid])
+
+
+def _add_manifest_entries(mount_point):
+    entries = _manifest.get(mount_point_id(mount_point), {})
+    for key, (module, classname, attrs) in entries.iteritems():
+        mount_point.plugins.add_lazy(key, module, classname, attrs)
+
+
+__all__.append('manifest_plugin_names')
+def manifest_plugin_names(mpid):
+    """Return plugin names registered in the manifest for mount point mpid"""
+    if mpid in _mount_points:
+        return _mount_points[mpid].plugins.keys()
+    return _manifest.get(mpid, {}).keys()
+
+
+def _abstract_methods(cls):
+    """Return sorted (name, member) list of abstract methods of cls"""
+    seen = set()
+    ams = []
+    for klass in cls.__mro__:
+        for key, member in klass.__dict__.iteritems():
+            if key in seen:
+                continue
+            seen.add(key)
+            if hasattr(member, '__call__') \
+                    and hasattr(member, 'abstract_method'):
+                ams.append((key, member))
+    ams.sort()
+    return ams
+
 
 __all__.append('GenericPluginMeta')
 class GenericPluginMeta(type):
@@ -223,22 +358,22 @@ class GenericPluginMeta(type):
     define an @abstractmethod method in that abstract subclass, and much more.
     """
     def __init__(mcs, name, bases, attrs):
-        super(GenericPluginMeta, mcs).__init__()
+        super(GenericPluginMeta, mcs).__init__(name, bases, attrs)
         logging.debug("META_INIT %s %s %s %s", mcs, name, bases, attrs)
         if not hasattr(mcs, 'plugins'):
             # This branch only executes when processing the mount point itself.
             # So, since this is a new plugin type, not an implementation, this
             # class shouldn't be registered as a plugin. Instead, it sets up a
-            # list where plugins can be registered later.
+            # list where plugins can be registered later, pre-populated with
+            # the plugins from the manifest, if there is one.
             mcs.plugins = PluginDict()
+            _mount_points[mount_point_id(mcs)] = mcs
+            _add_manifest_entries(mcs)
         elif mcs.name is not None:
             # This must be a plugin implementation, which should be registered.
             # Simply appending it to the list is all that's needed to keep
             # track of it later.
-            def abstract_method_filter(member):
-                return hasattr(member, '__call__') \
-                    and hasattr(member, 'abstract_method')
-            ams = inspect.getmembers(mcs, abstract_method_filter)
+            ams = _abstract_methods(mcs)
             if ams:
                 raise AbstractMethodsInConcreteClass(mcs, ams)
             logging.debug("Registering %s with %s as %s", mcs, mcs.plugins, mcs.name)
@@ -273,6 +408,8 @@ class GenericDetectPlugin(object):
     no_match_exception = PluginNoMatch
     """You may override this with a more plugin specific subclass of AmbigousPluginDetection"""
     ambigous_match_exception = AmbigousPluginDetection
+    """Files (relative to the tree root) a plugin's detection depends on"""
+    fingerprint_files = ()
 
     def __init__(self, context):
         super(GenericDetectPlugin, self).__init__()
@@ -308,16 +445,13 @@ class GenericDetectPlugin(object):
         if len(cls.plugins) < 1:
             raise NoPluginsRegistered(cls)
         matches = PluginDict()
-        for key, klass in cls.plugins.iteritems():
-            try:
-                t = klass(context, *args, **kwargs)
-                logging.debug("KLASS %s unvalidated, %s", klass,
-                              klass.validate)
-                if klass.validate(t, context, *args, **kwargs):
-                    logging.debug("KLASS %s validated", klass)
-                    matches[key] = t
-            except PluginNoMatch:
-                pass # ignore non-matching plugins
+        if getattr(context, 'parallel_detect', False):
+            probes = cls._probe_parallel(context, *args, **kwargs)
+        else:
+            probes = cls._probe_serial(context, *args, **kwargs)
+        for key, t in probes:
+            if t is not None:
+                matches[key] = t
         logging.debug("Matches: %s", matches)
         if len(matches) > 1:
             raise cls.ambigous_match_exception(matches,
@@ -328,4 +462,103 @@ class GenericDetectPlugin(object):
         logging.debug("Returning match from %s", matches)
         return matches[matches.keys()[0]]
 
+    @classmethod
+    def _probe(cls, klass, context, *args, **kwargs):
+        """Return validated instance of klass, or None if it does not match"""
+        span = trace.Span('probe %s' % klass.name, 'detect')
+        try:
+            try:
+                t = klass(context, *args, **kwargs)
+                logging.debug("KLASS %s unvalidated, %s", klass,
+                              klass.validate)
+                if klass.validate(t, context, *args, **kwargs):
+                    logging.debug("KLASS %s validated", klass)
+                    return t
+            except PluginNoMatch:
+                pass # ignore non-matching plugins
+            return None
+        finally:
+            span.end()
+
+    @classmethod
+    def _candidate_keys(cls, context, *args, **kwargs):
+        """Return names of the plugins worth probing for the given args
+
+        Override this in a subclass to rule out plugins cheaply, i.e.
+        without constructing (or even importing) them.
+        """
+        return cls.plugins.keys()
+
+    @classmethod
+    def _probe_serial(cls, context, *args, **kwargs):
+        """Generate (name, instance or None) for all plugins, one by one"""
+        for key in cls._candidate_keys(context, *args, **kwargs):
+            yield key, cls._probe(cls.plugins[key], context, *args, **kwargs)
+
+    @classmethod
+    def _probe_parallel(cls, context, *args, **kwargs):
+        """Return [(name, instance or None)] for all plugins, probed in threads
+
+        At most DETECT_THREADS probes run at the same time. If a probe
+        raises anything but PluginNoMatch, that exception is re-raised
+        here, for the first such plugin in the same order _probe_serial()
+        would have used.
+        """
+        keys = cls._candidate_keys(context, *args, **kwargs)
+        todo = Queue.Queue()
+        for key in keys:
+            todo.put(key)
+        results = {}
+        def worker():
+            while True:
+                try:
+                    key = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    t = cls._probe(cls.plugins[key], context, *args, **kwargs)
+                    results[key] = (t, None)
+                except:
+                    results[key] = (None, sys.exc_info())
+        threads = [threading.Thread(target=worker,
+                                    name="detect-%s" % cls.__name__)
+                   for i in range(min(len(keys), DETECT_THREADS))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        probes = []
+        for key in keys:
+            t, exc_info = results[key]
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            probes.append((key, t))
+        return probes
+
+    @classmethod
+    def detect_named(cls, name, context, *args, **kwargs):
+        """Construct and validate only the plugin registered as name
+
+        Raises cls.no_match_exception if that plugin does not match.
+        Useful for re-using a previous detect() result without probing
+        all the other plugins again.
+        """
+        logging.debug("DETECT_NAMED %s %s", cls, name)
+        klass = cls.plugins[name]
+        t = klass(context, *args, **kwargs)
+        if not klass.validate(t, context, *args, **kwargs):
+            raise cls.no_match_exception(*args, **kwargs)
+        return t
+
+    @classmethod
+    def all_fingerprint_files(cls):
+        """Return the fingerprint_files of all registered plugins"""
+        fnames = []
+        for key in cls.plugins.keys():
+            for fname in cls.plugins.peek(key, 'fingerprint_files', ()):
+                if fname not in fnames:
+                    fnames.append(fname)
+        fnames.sort()
+        return fnames
+
 
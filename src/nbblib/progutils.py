@@ -4,33 +4,125 @@ Utility functions for running external programs
 
 
 import os
+import sys
+import time
+import errno
+import signal
+import select
+import logging
+import threading
 import subprocess
+import collections
 
+from nbblib import trace
 
-__all__ = ['prog_stdout', 'prog_retstd', 'ProgramRunError', 'prog_run']
 
+__all__ = ['prog_stdout', 'prog_retstd', 'ProgramRunError', 'prog_run',
+           'cpu_count', 'parallel_jobs', 'prog_run_parallel',
+           'reset_max_rss', 'get_max_rss', 'TAIL_LINES',
+           'Job', 'ProgramRunner', 'ProgramKilledError', 'kill_children']
 
-def prog_stdout(call_list):
+
+_usage = threading.local()
+_all_usage = {'max_rss': 0}
+_all_usage_lock = threading.Lock()
+
+
+def _set_status(proc, status, rusage):
+    """Set proc.returncode from wait4() results, noting its peak RSS"""
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    _usage.max_rss = max(getattr(_usage, 'max_rss', 0), rusage.ru_maxrss)
+    _all_usage_lock.acquire()
+    try:
+        _all_usage['max_rss'] = max(_all_usage['max_rss'], rusage.ru_maxrss)
+    finally:
+        _all_usage_lock.release()
+    return proc.returncode
+
+
+def _wait4(pid, options):
+    while True:
+        try:
+            return os.wait4(pid, options)
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+def _wait(proc):
+    """Wait for proc to finish like proc.wait(), noting its peak RSS"""
+    pid, status, rusage = _wait4(proc.pid, 0)
+    return _set_status(proc, status, rusage)
+
+
+def reset_max_rss(all_threads=False):
+    """Start over measuring peak RSS of programs run by this thread
+
+    With all_threads, start over measuring it for the whole process.
+    """
+    if all_threads:
+        _all_usage_lock.acquire()
+        try:
+            _all_usage['max_rss'] = 0
+        finally:
+            _all_usage_lock.release()
+    else:
+        _usage.max_rss = 0
+
+
+def get_max_rss(all_threads=False):
+    """Return peak RSS (in kB) of programs run by this thread
+
+    That is the maximum since reset_max_rss() was last called, over all
+    programs prog_run() has run, including their child processes. With
+    all_threads, it is the maximum over the programs of all threads.
+    """
+    if all_threads:
+        return _all_usage['max_rss']
+    return getattr(_usage, 'max_rss', 0)
+
+
+def _span(call_list, cwd):
+    return trace.Span(os.path.basename(call_list[0]), 'run',
+                      {'cmd': call_list, 'cwd': cwd or os.getcwd()})
+
+
+def prog_stdout(call_list, cwd=None):
     """Run program and return stdout (similar to shell backticks)"""
-    proc = subprocess.Popen(call_list,
+    span = _span(call_list, cwd)
+    proc = subprocess.Popen(call_list, cwd=cwd,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
     stdout, stderr = proc.communicate(input=None)
+    span.end(retcode=proc.returncode)
     return stdout.strip()
 
 
-def prog_retstd(call_list):
+def prog_retstd(call_list, cwd=None):
     """Run program and return stdout (similar to shell backticks)"""
-    proc = subprocess.Popen(call_list,
+    span = _span(call_list, cwd)
+    proc = subprocess.Popen(call_list, cwd=cwd,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
     stdout, stderr = proc.communicate(input=None)
+    span.end(retcode=proc.returncode)
     return (proc.returncode, stdout.strip(), stderr.strip())
 
 
+"""Number of output lines a ProgramRunError keeps from a logged program"""
+TAIL_LINES = 20
+
+
 class ProgramRunError(Exception):
-    """A program run returns a retcode != 0"""
-    def __init__(self, call_list, retcode, cwd=None):
+    """A program run returns a retcode != 0
+
+    For programs run with a log file, tail holds the last lines of
+    their output.
+    """
+    def __init__(self, call_list, retcode, cwd=None, tail=None, logfile=None):
         super(ProgramRunError, self).__init__()
         self.call_list = call_list
         self.retcode = retcode
@@ -38,26 +130,572 @@ class ProgramRunError(Exception):
             self.cwd = cwd
         else:
             self.cwd = os.getcwd()
+        self.tail = list(tail or [])
+        self.logfile = logfile
+    def __str__(self):
+        msg = ("Error running program (%s, retcode=%d, cwd=%s)"
+               % (repr(self.call_list),
+                  self.retcode,
+                  repr(self.cwd)))
+        if self.tail:
+            msg += ("\nLast %d lines of output (full log in %s):\n%s"
+                    % (len(self.tail), self.logfile,
+                       "\n".join([ "| " + line for line in self.tail ])))
+        return msg
+
+
+class ProgramKilledError(ProgramRunError):
+    """The watchdog killed a program
+
+    reason is 'timeout' if the program has run longer than limit
+    seconds, and 'stalled' if it has not written any output for limit
+    seconds.
+    """
+    def __init__(self, call_list, retcode, cwd, tail, logfile, reason, limit):
+        super(ProgramKilledError, self).__init__(call_list, retcode, cwd,
+                                                 tail, logfile)
+        self.reason = reason
+        self.limit = limit
     def __str__(self):
-        return ("Error running program (%s, retcode=%d, cwd=%s)"
-                % (repr(self.call_list),
-                   self.retcode,
-                   repr(self.cwd)))
+        if self.reason == 'timeout':
+            why = "still running after %s seconds" % self.limit
+        else:
+            why = "no output for %s seconds" % self.limit
+        return ("Killed program (%s): %s\n%s"
+                % (repr(self.call_list), why,
+                   super(ProgramKilledError, self).__str__()))
+
+
+"""Seconds killed programs get to exit after SIGTERM before SIGKILL"""
+KILL_GRACE = 5
+
+
+_groups = set()
+_groups_lock = threading.Lock()
+
+
+def _popen_group(call_list, **kwargs):
+    """Start program as leader of a new process group, see kill_children()"""
+    proc = subprocess.Popen(call_list, preexec_fn=os.setpgrp, **kwargs)
+    _groups_lock.acquire()
+    try:
+        _groups.add(proc.pid)
+    finally:
+        _groups_lock.release()
+    return proc
+
+
+def _forget_group(proc):
+    _groups_lock.acquire()
+    try:
+        _groups.discard(proc.pid)
+    finally:
+        _groups_lock.release()
+
+
+def _killpg(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def kill_children(sig=signal.SIGTERM):
+    """Send sig to the process groups of all programs still running
 
+    These are the programs prog_run() runs with a logfile or a watchdog,
+    and the programs of ProgramRunners.
+    """
+    _groups_lock.acquire()
+    try:
+        groups = list(_groups)
+    finally:
+        _groups_lock.release()
+    for pgid in groups:
+        logging.debug("Killing process group %d", pgid)
+        _killpg(pgid, sig)
 
-def prog_run(call_list, context=None, env=None, env_update=None):
-    """Run program showing its output. Raise exception if retcode != 0."""
+
+def prog_run(call_list, context=None, env=None, env_update=None,
+             jobserver=None, cwd=None, logfile=None, timeout=None,
+             stall_timeout=None):
+    """Run program showing its output. Raise exception if retcode != 0.
+
+    If a jobserver.JobServer is given, make processes started by the
+    program will take their job slots from it. The program runs in cwd
+    if given, and in the current directory otherwise.
+
+    If logfile is given, the program's output is written to it, too, and
+    the last lines of it end up in the ProgramRunError. With the quiet
+    context property set, the output is only written to logfile, and a
+    progress line is shown instead if stderr is a terminal.
+
+    With a timeout or stall_timeout (in seconds), a watchdog kills the
+    program and its children when it runs longer than timeout, or has
+    not written any output for stall_timeout, raising ProgramKilledError.
+
+    Programs with a logfile or a watchdog run through a ProgramRunner,
+    i.e. in a process group of their own with /dev/null as stdin. Other
+    programs share nbb's terminal.
+    """
+    if not cwd:
+        cwd = os.getcwd()
     print "RUN:", call_list
-    print "  in", os.getcwd()
+    print "  in", cwd
+    # Show that before the program's output, which may bypass sys.stdout
+    sys.stdout.flush()
     if context and context.dry_run:
         return None
     if not env:
         env = os.environ.copy()
+    if jobserver:
+        env.update(jobserver.make_env_update())
     if env_update:
         env.update(env_update)
-    proc = subprocess.Popen(call_list, env=env)
-    stdout, stderr = proc.communicate(input=None)
-    if proc.returncode != 0:
-        raise ProgramRunError(call_list, proc.returncode, os.getcwd())
-    return proc.returncode
+    if not (logfile or timeout or stall_timeout):
+        span = _span(call_list, cwd)
+        proc = subprocess.Popen(call_list, env=env, cwd=cwd)
+        _wait(proc)
+        span.end(retcode=proc.returncode)
+        if proc.returncode != 0:
+            raise ProgramRunError(call_list, proc.returncode, cwd)
+        return proc.returncode
+    quiet = context and context.quiet
+    runner = ProgramRunner(1, context)
+    job = runner.submit(call_list, cwd, env, logfile=logfile,
+                        echo=not quiet,
+                        progress=quiet and sys.stderr.isatty(),
+                        timeout=timeout, stall_timeout=stall_timeout)
+    try:
+        runner.wait([job])
+    except:
+        # e.g. KeyboardInterrupt: Do not leave the program behind
+        runner.cancel(job)
+        runner.wait([job])
+        raise
+    if job.killed:
+        reason, limit = job.killed
+        raise ProgramKilledError(call_list, job.returncode, cwd,
+                                 job.tail, logfile, reason, limit)
+    if job.returncode != 0:
+        raise ProgramRunError(call_list, job.returncode, cwd,
+                              job.tail, logfile)
+    return job.returncode
+
+
+
+def cpu_count():
+    """Return number of online CPUs (1 if that cannot be determined)"""
+    try:
+        n = os.sysconf('SC_NPROCESSORS_ONLN')
+    except (AttributeError, ValueError, OSError):
+        n = -1
+    if n < 1:
+        n = 1
+    return n
+
+
+def parallel_jobs(jobs=None):
+    """Return (jobs, max_load) for parallel builds, e.g. make -j -l
+
+    Unless the number of jobs is given, it is the number of CPUs not
+    already kept busy according to the current load average, but at
+    least 1. max_load is the number of CPUs.
+    """
+    cpus = cpu_count()
+    if not jobs:
+        try:
+            load = os.getloadavg()[0]
+        except (AttributeError, OSError):
+            load = 0.0
+        jobs = max(1, min(cpus, int(cpus - load + 0.5)))
+    return jobs, cpus
+
+
+def prog_run_parallel(jobs, max_procs, context=None):
+    """Run several programs at once, each logging to its own file
+
+    @param jobs list of (key, call_list, cwd, logfile)
+    @param max_procs maximum number of programs running at the same time
+    @return dict mapping key to (retcode, duration in seconds)
+    """
+    runner = ProgramRunner(max_procs, context)
+    started = [ runner.run(call_list, cwd, logfile=logfile, key=key)
+                for key, call_list, cwd, logfile in jobs ]
+    runner.wait()
+    return dict([ (job.key, (job.returncode, job.duration))
+                  for job in started ])
+
+
+class Job(object):
+    """A program run by a ProgramRunner
+
+    After the job is done, returncode is set (None for jobs cancelled
+    before they started), and for captured jobs stdout and stderr hold
+    the program's output. tail holds the last TAIL_LINES lines of
+    output, and killed is (reason, limit) as for ProgramKilledError if
+    the watchdog has killed the program.
+    """
+
+    def __init__(self, runner, key, call_list, cwd, env, logfile, on_line,
+                 capture, verbose, echo, progress, timeout, stall_timeout):
+        super(Job, self).__init__()
+        self.runner = runner
+        self.key = key
+        self.call_list = call_list
+        self.cwd = cwd or os.getcwd()
+        self.env = env
+        self.logfile = logfile
+        self.on_line = on_line
+        self.capture = capture
+        self.verbose = verbose
+        self.echo = echo
+        self.progress = progress
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.proc = None
+        self.returncode = None
+        self.cancelled = False
+        self.killed = None
+        self.start = None
+        self.end = None
+        self.last_output = None
+        self.tail = collections.deque()
+        self._log = None
+        self._open = 0
+        self._nlines = 0
+        self._kill_deadline = None
+        self._hard_killed = False
+        self._trace = (str(key), None)
+        self._output = {'stdout': [], 'stderr': []}
+        self._partial = {'stdout': '', 'stderr': ''}
+
+    def get_done(self):
+        return (self.end is not None) or (self.cancelled and not self.proc)
+    done = property(get_done)
+
+    def get_duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+    duration = property(get_duration)
+
+    def get_stdout(self):
+        return ''.join(self._output['stdout'])
+    stdout = property(get_stdout)
+
+    def get_stderr(self):
+        return ''.join(self._output['stderr'])
+    stderr = property(get_stderr)
+
+    def cancel(self):
+        self.runner.cancel(self)
+
+    def _data(self, name, data):
+        self.last_output = time.time()
+        if self.capture:
+            self._output[name].append(data)
+        if self._log:
+            self._log.write(data)
+        lines = (self._partial[name] + data).split('\n')
+        self._partial[name] = lines.pop()
+        for line in lines:
+            self._line(name, line)
+        self._show_progress(lines)
+
+    def _eof(self, name):
+        rest = self._partial[name]
+        self._partial[name] = ''
+        if rest:
+            self._line(name, rest)
+            self._show_progress([rest])
+
+    def _line(self, name, line):
+        self.tail.append(line)
+        if len(self.tail) > TAIL_LINES:
+            self.tail.popleft()
+        self._nlines += 1
+        if self.on_line:
+            self.on_line(self, name, line)
+        elif self.echo:
+            stream = getattr(sys, name)
+            stream.write(line + '\n')
+            stream.flush()
+
+    def _show_progress(self, lines):
+        if self.progress and lines:
+            sys.stderr.write("\r  %d lines of output, see %s"
+                             % (self._nlines, self.logfile))
+            sys.stderr.flush()
+
+    def _watchdog(self, now):
+        """Return (reason, limit) if the program must be killed, or None"""
+        if self.timeout and now - self.start >= self.timeout:
+            return ('timeout', self.timeout)
+        if self.stall_timeout and now - self.last_output >= self.stall_timeout:
+            return ('stalled', self.stall_timeout)
+        return None
+
+    def _deadline(self):
+        """Return when the runner must look at this job next, or None"""
+        if self._kill_deadline is not None:
+            if self._hard_killed:
+                return None
+            return self._kill_deadline
+        deadlines = []
+        if self.timeout:
+            deadlines.append(self.start + self.timeout)
+        if self.stall_timeout:
+            deadlines.append(self.last_output + self.stall_timeout)
+        return deadlines and min(deadlines) or None
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, repr(self.key),
+                               repr(self.call_list))
+
+
+class ProgramRunner(object):
+    """Run many programs at once from a single thread
+
+    run(), capture() and stream() start a program (or queue it, if
+    max_procs programs are running already) and return a Job at once.
+    wait() then starts queued jobs and handles the output of all running
+    jobs using select() until the jobs waited for are done. Jobs can be
+    cancelled, which kills them if they are running.
+
+    The programs get /dev/null as stdin, and each leads a process group
+    of its own. Killing a job sends SIGTERM to its process group, and
+    SIGKILL to what is left of it KILL_GRACE seconds later, or once the
+    program has exited.
+
+    Jobs submitted with a timeout or stall_timeout (in seconds) are
+    killed by a watchdog when they run longer than timeout, or have not
+    written any output for stall_timeout.
+    """
+
+    def __init__(self, max_procs=None, context=None):
+        super(ProgramRunner, self).__init__()
+        if not max_procs:
+            max_procs = cpu_count()
+        self.max_procs = max_procs
+        self.context = context
+        self._pending = []
+        self._running = []
+        self._fds = {}
+        self._count = 0
+
+    def submit(self, call_list, cwd=None, env=None, logfile=None,
+               on_line=None, capture=False, verbose=False, echo=False,
+               progress=False, timeout=None, stall_timeout=None, key=None):
+        """Start (or queue) program, return its Job
+
+        @param logfile       file to write the output to
+        @param on_line       see stream()
+        @param capture       keep the output in the Job
+        @param verbose       show RUN: lines, and honour dry_run
+        @param echo          show the output line by line
+        @param progress      show a progress line on stderr
+        @param timeout       watchdog limit on the run time
+        @param stall_timeout watchdog limit on the time without output
+        @param key           name of the job (default: a number)
+        """
+        if key is None:
+            key = self._count
+            # Trace events of unnamed jobs go to the caller's lane
+            trace_name = os.path.basename(call_list[0])
+            trace_lane = None
+        else:
+            trace_name = str(key)
+            trace_lane = ('runner', key)
+        self._count += 1
+        job = Job(self, key, call_list, cwd, env, logfile, on_line,
+                  capture, verbose, echo, progress, timeout, stall_timeout)
+        job._trace = (trace_name, trace_lane)
+        self._pending.append(job)
+        self._start_pending()
+        return job
+
+    def run(self, call_list, cwd=None, env=None, logfile=None, key=None):
+        """Run program like prog_run(), writing its output to logfile
+
+        Without logfile, the output is shown line by line.
+        """
+        return self.submit(call_list, cwd, env, logfile=logfile,
+                           verbose=True, echo=not logfile, key=key)
+
+    def capture(self, call_list, cwd=None, env=None, key=None):
+        """Run program like prog_retstd(), keeping its output in the Job"""
+        return self.submit(call_list, cwd, env, capture=True, key=key)
+
+    def stream(self, call_list, on_line, cwd=None, env=None, key=None):
+        """Run program calling on_line(job, name, line) for every line
+
+        name is 'stdout' or 'stderr', and line comes without the newline.
+        """
+        return self.submit(call_list, cwd, env, on_line=on_line, key=key)
+
+    def cancel(self, job):
+        """Do not start job if queued, and kill it if running
+
+        Running jobs are killed together with their children, as every
+        job's program leads a process group of its own.
+        """
+        if job in self._pending:
+            self._pending.remove(job)
+            job.cancelled = True
+        elif job in self._running and not job.cancelled:
+            job.cancelled = True
+            self._kill(job)
+
+    def cancel_all(self):
+        for job in self._pending + self._running:
+            self.cancel(job)
+
+    def _kill(self, job):
+        if job._kill_deadline is None:
+            _killpg(job.proc.pid, signal.SIGTERM)
+            job._kill_deadline = time.time() + KILL_GRACE
+
+    def _watch(self, job, now):
+        """Act on the watchdog limits and on kills taking too long"""
+        if job._kill_deadline is None:
+            killed = job._watchdog(now)
+            if killed:
+                logging.debug("Watchdog kills %s: %s", job.call_list, killed)
+                job.killed = killed
+                self._kill(job)
+        elif not job._hard_killed and now >= job._kill_deadline:
+            _killpg(job.proc.pid, signal.SIGKILL)
+            job._hard_killed = True
+
+    def _start_pending(self):
+        while self._pending and len(self._running) < self.max_procs:
+            self._start(self._pending.pop(0))
+
+    def _start(self, job):
+        if job.verbose:
+            print "RUN:", job.call_list
+            print "  in", job.cwd
+        job.start = job.last_output = time.time()
+        if job.verbose and self.context and self.context.dry_run:
+            job.returncode = 0
+            job.end = job.start
+            return
+        devnull = open(os.devnull, 'r')
+        try:
+            job.proc = _popen_group(job.call_list, cwd=job.cwd,
+                                    env=job.env, stdin=devnull,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        finally:
+            devnull.close()
+        if job.logfile:
+            logdir = os.path.dirname(job.logfile)
+            if logdir and not os.path.exists(logdir):
+                os.makedirs(logdir)
+            job._log = open(job.logfile, 'w')
+        for name in ('stdout', 'stderr'):
+            self._fds[getattr(job.proc, name).fileno()] = (job, name)
+        job._open = 2
+        self._running.append(job)
+
+    def _close(self, fd):
+        job, name = self._fds.pop(fd)
+        getattr(job.proc, name).close()
+        job._eof(name)
+        job._open -= 1
+
+    def _read(self, fd):
+        job, name = self._fds[fd]
+        data = os.read(fd, 65536)
+        if data:
+            job._data(name, data)
+        else:
+            self._close(fd)
+
+    def _reap(self, job):
+        """Finish job if its program has exited"""
+        pid, status, rusage = _wait4(job.proc.pid, os.WNOHANG)
+        if pid == 0:
+            return
+        _set_status(job.proc, status, rusage)
+        if job._kill_deadline is not None:
+            # Whatever is left of the process group does not get a
+            # second chance, and may keep the output pipes open
+            _killpg(job.proc.pid, signal.SIGKILL)
+            for fd, (fd_job, name) in self._fds.items():
+                if fd_job is job:
+                    self._close(fd)
+        _forget_group(job.proc)
+        job.returncode = job.proc.returncode
+        job.end = time.time()
+        if job._log:
+            job._log.close()
+            job._log = None
+        if job.progress and job._nlines:
+            sys.stderr.write("\n")
+        self._running.remove(job)
+        trace_name, trace_lane = job._trace
+        trace.add_event(trace_name, 'run', job.start, job.end,
+                        {'cmd': job.call_list, 'cwd': job.cwd,
+                         'retcode': job.returncode},
+                        tid=trace_lane)
+
+    def poll(self, timeout=None):
+        """Handle output and exits of running jobs, for at most timeout"""
+        now = time.time()
+        for job in self._running:
+            self._watch(job, now)
+        deadlines = [ job._deadline() for job in self._running ]
+        deadlines = [ deadline for deadline in deadlines
+                      if deadline is not None ]
+        if deadlines:
+            delay = max(0, min(deadlines) - now)
+            if timeout is None or delay < timeout:
+                timeout = delay
+        if self._fds:
+            try:
+                readable = select.select(self._fds.keys(), [], [],
+                                         timeout)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            for fd in readable:
+                self._read(fd)
+        elif timeout:
+            time.sleep(timeout)
+        now = time.time()
+        for job in self._running[:]:
+            self._watch(job, now)
+            if not job._open or job._hard_killed:
+                self._reap(job)
+        self._start_pending()
+
+    def wait(self, jobs=None, timeout=None):
+        """Run jobs (default: all jobs) until done, or timeout has passed
 
+        Return True if the jobs are done.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            self._start_pending()
+            if jobs is None:
+                waiting = self._pending + self._running
+            else:
+                waiting = [ job for job in jobs if not job.done ]
+            if not waiting:
+                return True
+            delay = None
+            if timeout is not None:
+                delay = deadline - time.time()
+                if delay <= 0:
+                    return False
+            if [ job for job in self._running
+                 if not job._open or job._hard_killed ]:
+                # Output closed (or killed for good), but still running:
+                # check again soon
+                delay = min(delay or 0.05, 0.05)
+            self.poll(delay)
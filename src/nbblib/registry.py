@@ -0,0 +1,95 @@
+"""\
+nbblib.registry - nbb's plugin mount points and plugin manifest
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+At build time, generate_manifest() imports all plugin modules and writes
+nbblib/manifest.py, which records for every plugin its name, module,
+class name, and a few class attributes. At run time, load_plugins()
+registers that manifest with the plugins module, so that the plugins
+can be listed and dispatched to without importing all plugin modules.
+Only when a plugin is actually looked up is its module imported.
+
+Without a manifest (e.g. when running from an unbuilt source tree),
+load_plugins() simply imports all plugin modules.
+"""
+
+
+import sys
+import pprint
+import logging
+
+from nbblib import plugins
+
+
+__all__ = []
+
+
+"""Modules defining plugins (including the mount point modules)"""
+PLUGIN_MODULES = ['nbblib.commands',
+                  'nbblib.nbbcommands',
+                  'nbblib.vcs',
+                  'nbblib.bs',
+                  ]
+
+
+"""Plugin mount points, as plugins.mount_point_id() strings"""
+COMMAND = 'nbblib.commands.Command'
+VCS = 'nbblib.vcs.VCSourceTree'
+BS = 'nbblib.bs.BSSourceTree'
+MOUNT_POINTS = [COMMAND, VCS, BS]
+
+
+"""Plugin class attributes recorded in the manifest"""
+MANIFEST_ATTRS = ('summary', 'usage', 'fingerprint_files', 'marker_files', )
+
+
+def import_plugin_modules():
+    """Import all plugin modules, thus registering all plugins"""
+    for module in PLUGIN_MODULES:
+        __import__(module)
+
+
+__all__.append('load_plugins')
+def load_plugins():
+    """Make all plugins known, from the manifest if possible"""
+    try:
+        from nbblib.manifest import MANIFEST
+    except ImportError:
+        logging.debug("No plugin manifest, importing all plugin modules")
+        import_plugin_modules()
+    else:
+        plugins.register_manifest(MANIFEST)
+
+
+__all__.append('plugin_names')
+def plugin_names(mpid):
+    """Return sorted list of plugin names for mount point id mpid"""
+    names = plugins.manifest_plugin_names(mpid)
+    if not names:
+        import_plugin_modules()
+        names = plugins.manifest_plugin_names(mpid)
+    names.sort()
+    return names
+
+
+__all__.append('generate_manifest')
+def generate_manifest():
+    """Return python source code for the nbblib.manifest module"""
+    import_plugin_modules()
+    manifest = {}
+    for mpid in MOUNT_POINTS:
+        module, classname = mpid.rsplit('.', 1)
+        mount_point = getattr(sys.modules[module], classname)
+        entries = manifest[mpid] = {}
+        for key in mount_point.plugins.keys():
+            klass = mount_point.plugins[key]
+            attrs = {}
+            for attr in MANIFEST_ATTRS:
+                if hasattr(klass, attr):
+                    attrs[attr] = getattr(klass, attr)
+            entries[key] = (klass.__module__, klass.__name__, attrs)
+    return "\n".join(["# nbblib/manifest.py - generated by nbblib.registry",
+                      "# Do not edit. Regenerated on every build.",
+                      "",
+                      "MANIFEST = %s" % pprint.pformat(manifest),
+                      ""])
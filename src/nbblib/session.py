@@ -0,0 +1,234 @@
+"""\
+nbblib.session - run many nbb commands in one process
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+A Session runs nbb command lines like the nbb program does, but all in
+the same python process:
+
+    session = Session(['--no-history'])
+    code = session.run(['build'], cwd='/path/to/tree')
+
+Python and nbblib start up just once, and the commands share the
+per-process caches (parsed .nbb.conf files, detection cache files), so
+a tree is examined in full only by the first command run in it.
+
+run_many() runs a list of (cwd, args) commands, optionally several at
+a time: Then the commands for each source tree run one after the other
+in a forked process, with the output shown when they are done.
+
+'nbb batch' reads such a list from a file (see parse_batch()).
+"""
+
+
+import os
+import sys
+import errno
+import shlex
+import marshal
+import logging
+import tempfile
+
+from nbblib import commands
+from nbblib import registry
+
+
+__all__ = []
+
+
+__all__.append('Session')
+class Session(object):
+    """Runs nbb commands in the current process
+
+    @param global_args global options for every command, e.g. ['-n']
+    @param argv0       program name to use in messages
+    """
+
+    def __init__(self, global_args=(), argv0='nbb'):
+        super(Session, self).__init__()
+        self.global_args = list(global_args)
+        self.argv0 = argv0
+        registry.load_plugins()
+
+    def run(self, args, cwd=None):
+        """Run nbb command line args (without argv0) in cwd
+
+        Return the exit code nbb would exit with. Errors are reported
+        like nbb does.
+        """
+        from nbblib import main
+        old_cwd = os.getcwd()
+        if cwd:
+            os.chdir(cwd)
+        try:
+            try:
+                main.main([self.argv0] + self.global_args + list(args))
+                return 0
+            except Exception, e:
+                code = main.exit_code(e)
+                if code is None:
+                    raise
+                logging.error(e)
+                return code
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.chdir(old_cwd)
+
+    def _run_sequence(self, cmds, keep_going, announce):
+        codes = []
+        for cwd, args in cmds:
+            if codes and codes[-1] != 0 and not keep_going:
+                codes.append(None)
+                continue
+            if announce:
+                print "BATCH: %s" % ' '.join([self.argv0] + list(args))
+                print "  in", cwd
+            codes.append(self.run(args, cwd))
+        return codes
+
+    def run_many(self, cmds, jobs=1, keep_going=False, announce=True):
+        """Run list of (cwd, args) commands, returning their exit codes
+
+        After a command has failed, the following commands (for the
+        same source tree, if jobs > 1) are not run, and get None as exit
+        code, unless keep_going is set.
+
+        With jobs > 1, the commands for up to jobs source trees run at
+        the same time, each tree's commands in order in a forked process.
+        """
+        if jobs <= 1:
+            return self._run_sequence(cmds, keep_going, announce)
+        groups = []
+        indices = {}
+        tree_keys = {}
+        for i, (cwd, args) in enumerate(cmds):
+            if cwd not in tree_keys:
+                tree_keys[cwd] = self._tree_key(cwd)
+            key = tree_keys[cwd]
+            if key not in indices:
+                indices[key] = []
+                groups.append(key)
+            indices[key].append(i)
+        codes = [ None ] * len(cmds)
+        running = {}
+        todo = list(groups)
+        todo.reverse()
+        while todo or running:
+            while todo and len(running) < jobs:
+                key = todo.pop()
+                group = [ cmds[i] for i in indices[key] ]
+                logging.debug("Running %d batch commands for %s",
+                              len(group), repr(key))
+                pid, files = self._fork(group, keep_going, announce)
+                running[pid] = (key, files)
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid not in running:
+                continue
+            key, files = running.pop(pid)
+            out, err, result = files
+            for f, stream in ((out, sys.stdout), (err, sys.stderr)):
+                f.seek(0)
+                stream.write(f.read())
+                stream.flush()
+                f.close()
+            result.seek(0)
+            try:
+                group_codes = marshal.load(result)
+            except (EOFError, ValueError, TypeError):
+                logging.error("Batch commands in %s died (status %d)",
+                              key, status)
+                group_codes = [ 1 ] * len(indices[key])
+            result.close()
+            for i, code in zip(indices[key], group_codes):
+                codes[i] = code
+        return codes
+
+    def _tree_key(self, cwd):
+        """Return the root of the source tree cwd is in
+
+        Commands for the same tree share its builddir and stage state,
+        so they must not run at the same time. Directories outside of
+        source trees stand for themselves.
+        """
+        from nbblib import main, plugins, vcs
+        cwd = os.path.realpath(cwd)
+        try:
+            return vcs.VCSourceTree.detect(main.Context(), cwd).tree_root
+        except (plugins.PluginNoMatch, plugins.AmbigousPluginDetection,
+                OSError), e:
+            logging.debug("No source tree for %s: %s", repr(cwd), e)
+            return cwd
+
+    def _fork(self, group, keep_going, announce):
+        """Start process running group's commands; return (pid, files)
+
+        The process writes stdout, stderr and the marshalled exit codes
+        to the three temporary files.
+        """
+        files = (tempfile.TemporaryFile(), tempfile.TemporaryFile(),
+                 tempfile.TemporaryFile())
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            return pid, files
+        try:
+            try:
+                out, err, result = files
+                os.dup2(out.fileno(), 1)
+                os.dup2(err.fileno(), 2)
+                codes = self._run_sequence(group, keep_going, announce)
+                marshal.dump(codes, result)
+                result.flush()
+            except:
+                logging.error("Batch commands failed", exc_info=True)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
+
+
+__all__.append('parse_batch')
+def parse_batch(lines, cwd, filename='<stdin>'):
+    """Return list of (cwd, args) from lines of a batch file
+
+    Every line holds the arguments for one nbb command, quoted like for
+    the shell, e.g.
+
+        config builddir _build
+        build-test
+
+    Empty lines and '#' comments are ignored. 'cd <dir>' lines change
+    the directory the following commands run in; relative directories
+    are relative to the previous one, starting with cwd.
+    """
+    cmds = []
+    lineno = 0
+    for line in lines:
+        lineno += 1
+        try:
+            args = shlex.split(line, comments=True)
+        except ValueError, e:
+            raise commands.CommandLineError("%s:%d: %s"
+                                            % (filename, lineno, e))
+        if not args:
+            continue
+        if args[0] == 'cd':
+            if len(args) != 2:
+                raise commands.CommandLineError(\
+                    "%s:%d: 'cd' takes exactly one directory"
+                    % (filename, lineno))
+            cwd = os.path.normpath(os.path.join(cwd, args[1]))
+            continue
+        if commands.command_name(args) == 'batch':
+            raise commands.CommandLineError(\
+                "%s:%d: batch commands cannot run batches"
+                % (filename, lineno))
+        cmds.append((cwd, args))
+    return cmds
+
@@ -0,0 +1,235 @@
+"""\
+nbblib.stages - build stages of a BS source tree and their scheduling
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+A BS plugin declares its build stages as a list of Stage objects in its
+stages class attribute, e.g.
+
+    stages = (Stage('configure', '_do_configure', deps=('init', ),
+                    inputs='_configure_inputs',
+                    outputs='_configure_outputs',
+                    extra='_configure_extra'),
+              ...
+              )
+
+with the strings naming methods of the plugin. The Scheduler then
+runs the stages required for some target stages in dependency order:
+A stage runs if one of the stages it depends on has run, if one of its
+outputs is missing, or if its inputs have changed since it last ran
+(see nbblib.stamps). Stages whose dependencies are done run at the
+same time, each in its own thread. Stage actions therefore must not
+change the process's current directory.
+"""
+
+
+import os
+import sys
+import time
+import Queue
+import logging
+import threading
+
+from nbblib import progutils
+from nbblib import trace
+
+
+__all__ = []
+
+
+__all__.append('Stage')
+class Stage(object):
+    """Declaration of a build stage
+
+    @param name    stage name, e.g. 'build'
+    @param action  name of the method doing the work
+    @param deps    names of the stages which must be done first
+    @param inputs  name of method returning the input files
+                   (relative to the tree root); None for no input files
+    @param outputs name of method returning the paths which must exist
+                   for the stage to be up to date
+    @param extra   name of method returning other data the stage depends
+                   on (e.g. command line arguments), must be marshallable
+    """
+
+    def __init__(self, name, action, deps=(), inputs=None, outputs=None,
+                 extra=None):
+        super(Stage, self).__init__()
+        self.name = name
+        self.action = action
+        self.deps = tuple(deps)
+        self.inputs = inputs
+        self.outputs = outputs
+        self.extra = extra
+
+    def _call(self, tree, attr, default):
+        if attr is None:
+            return default
+        return getattr(tree, attr)()
+
+    def get_inputs(self, tree):
+        return self._call(tree, self.inputs, [])
+
+    def get_outputs(self, tree):
+        return self._call(tree, self.outputs, [])
+
+    def get_extra(self, tree):
+        return self._call(tree, self.extra, None)
+
+    def run(self, tree):
+        getattr(tree, self.action)()
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+
+__all__.append('UnknownStage')
+class UnknownStage(Exception):
+    def __init__(self, tree, name):
+        super(UnknownStage, self).__init__()
+        self.tree = tree
+        self.name = name
+    def __str__(self):
+        return "No stage %s in %s build system" % (repr(self.name),
+                                                  self.tree.name)
+
+
+__all__.append('Scheduler')
+class Scheduler(object):
+    """Run the stages of a BS source tree which are out of date"""
+
+    def __init__(self, tree):
+        super(Scheduler, self).__init__()
+        self.tree = tree
+        self.stages = {}
+        self.order = []
+        for stage in tree.stages:
+            self.stages[stage.name] = stage
+            self.order.append(stage.name)
+
+    def required(self, targets):
+        """Return names of target stages and their deps, in declared order"""
+        needed = set()
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in self.stages:
+                raise UnknownStage(self.tree, name)
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].deps)
+        return [ name for name in self.order if name in needed ]
+
+    def _full_extra(self, stage):
+        """Stage's extra data together with the state of its deps"""
+        state = self.tree.stage_state
+        return (stage.get_extra(self.tree),
+                tuple([ state.digest(dep) for dep in stage.deps ]))
+
+    def _is_current(self, stage, ran):
+        context = self.tree.context
+        if context and context.force:
+            return False
+        for dep in stage.deps:
+            if ran[dep]:
+                return False
+        for path in stage.get_outputs(self.tree):
+            if not os.path.exists(path):
+                logging.debug("Stage %s output %s is missing",
+                              stage.name, repr(path))
+                return False
+        return self.tree.stage_state.is_current(stage.name,
+                                                self.tree.tree_root,
+                                                stage.get_inputs(self.tree),
+                                                self._full_extra(stage))
+
+    def _record(self, stage):
+        context = self.tree.context
+        if context and context.dry_run:
+            return
+        self.tree.stage_state.record(stage.name, self.tree.tree_root,
+                                     stage.get_inputs(self.tree),
+                                     self._full_extra(stage))
+
+    def _record_history(self, stage, exc_info, started, duration, max_rss):
+        if not exc_info:
+            exit_code = 0
+        elif isinstance(exc_info[1], progutils.ProgramRunError):
+            exit_code = exc_info[1].retcode
+        else:
+            exit_code = 1
+        from nbblib import history
+        history.record(self.tree.context, self.tree.tree_root,
+                       history.branch_name(self.tree.vcs_tree), stage.name,
+                       started, duration, exit_code, max_rss)
+
+    def run(self, targets):
+        """Run the target stages and what they need, as far as out of date"""
+        pending = self.required(targets)
+        logging.debug("Stages required for %s: %s", targets, pending)
+        ran = {}
+        running = set()
+        results = Queue.Queue()
+        error = None
+        def worker(stage):
+            span = trace.Span(stage.name, 'stage')
+            progutils.reset_max_rss()
+            try:
+                stage.run(self.tree)
+                span.end()
+                exc_info = None
+            except:
+                span.end(failed=True)
+                exc_info = sys.exc_info()
+            results.put((stage, exc_info, span.start,
+                         time.time() - span.start, progutils.get_max_rss()))
+        while pending or running:
+            ready = []
+            if error is None:
+                for name in pending:
+                    stage = self.stages[name]
+                    if [ dep for dep in stage.deps if dep not in ran ]:
+                        continue
+                    span = trace.Span("check %s" % name, 'stamps')
+                    current = self._is_current(stage, ran)
+                    span.end(current=current)
+                    if current:
+                        print "UP-TO-DATE:", name
+                        ran[name] = False
+                    else:
+                        ready.append(stage)
+                for name in ran:
+                    if name in pending:
+                        pending.remove(name)
+                for stage in ready:
+                    pending.remove(stage.name)
+            else:
+                pending = []
+            if len(ready) == 1 and not running:
+                # Nothing to run in parallel, so do not bother with threads
+                worker(ready[0])
+            else:
+                for stage in ready:
+                    thread = threading.Thread(target=worker, args=(stage, ),
+                                              name="stage-%s" % stage.name)
+                    thread.start()
+            running.update([ stage.name for stage in ready ])
+            if not running:
+                continue
+            # With a timeout, Queue.get() can be interrupted by Ctrl-C
+            while True:
+                try:
+                    result = results.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+            stage, exc_info, started, duration, max_rss = result
+            running.remove(stage.name)
+            self._record_history(stage, exc_info, started, duration, max_rss)
+            if exc_info:
+                if error is None:
+                    error = exc_info
+                continue
+            self._record(stage)
+            ran[stage.name] = True
+        if error:
+            raise error[0], error[1], error[2]
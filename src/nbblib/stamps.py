@@ -0,0 +1,206 @@
+"""\
+nbblib.stamps - remember build stage inputs to skip up-to-date stages
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+For every build stage (init, configure, build, install) which has run
+successfully, the stage state file in the builddir records the stage's
+input files with their size, mtime and content hash, plus some extra
+data (e.g. the configure options, and the state of the stages it
+depends on). A stage is up to date if its input files and extra data
+are still the same.
+
+Files whose size and mtime have not changed are assumed unchanged, so
+checking a stage costs a stat() per input file. Only files with a new
+mtime are hashed, so that e.g. touching a file does not cause a
+rebuild.
+"""
+
+
+import os
+import stat
+import errno
+import logging
+import marshal
+import hashlib
+
+from nbblib import cache
+
+
+__all__ = []
+
+
+__all__.append('STATE_FILE_NAME')
+STATE_FILE_NAME = '.nbb-stages'
+
+
+__all__.append('hash_file')
+def hash_file(path, st):
+    """Return hex digest of the contents of file path with stat data st"""
+    if not stat.S_ISREG(st.st_mode):
+        # Never read FIFOs and the like
+        return None
+    md5 = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            md5.update(data)
+    finally:
+        f.close()
+    return md5.hexdigest()
+
+
+__all__.append('tree_files')
+def tree_files(topdir, prune=()):
+    """Return sorted list of files below topdir, relative to topdir
+
+    Hidden files and directories are skipped, as are directories
+    containing other VCS work trees (like git worktrees or checkouts
+    of other branches). For directories in prune which are inside
+    topdir, the whole top level directory containing them is skipped
+    (e.g. all of _build/ for a builddir _build/master).
+    """
+    # os.path.relpath() is python 2.6
+    prefix = os.path.join(os.path.abspath(topdir), '')
+    skip = []
+    for pdir in prune:
+        pdir = os.path.abspath(pdir)
+        if pdir.startswith(prefix):
+            skip.append(pdir[len(prefix):].split(os.sep)[0])
+    files = []
+    for dirpath, dirnames, filenames in os.walk(topdir):
+        if dirpath != topdir and ('.git' in dirnames or '.git' in filenames or
+                                  '.bzr' in dirnames):
+            del dirnames[:]
+            continue
+        if dirpath == topdir:
+            dirnames[:] = [ d for d in dirnames if d not in skip ]
+        dirnames[:] = [ d for d in dirnames if not d.startswith('.') ]
+        reldir = dirpath[len(topdir):].lstrip(os.sep)
+        for fname in filenames:
+            if fname.startswith('.'):
+                continue
+            if reldir:
+                files.append(os.path.join(reldir, fname))
+            else:
+                files.append(fname)
+    files.sort()
+    return files
+
+
+__all__.append('StageState')
+class StageState(object):
+    """Stage state file in a build directory"""
+
+    def __init__(self, builddir):
+        super(StageState, self).__init__()
+        self.filename = os.path.join(builddir, STATE_FILE_NAME)
+        self._stages = None
+
+    def _get_stages(self):
+        if self._stages is None:
+            self._stages = {}
+            try:
+                f = open(self.filename, 'rb')
+                try:
+                    self._stages = marshal.load(f)
+                finally:
+                    f.close()
+            except (IOError, OSError, EOFError, ValueError, TypeError), e:
+                logging.debug("Cannot read stage state %s: %s",
+                              repr(self.filename), e)
+        return self._stages
+    stages = property(_get_stages)
+
+    def _save(self):
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        cache.write_atomically(self.filename, marshal.dumps(self.stages))
+
+    def _file_states(self, topdir, files, old_states):
+        """Return {file: (size, mtime, hash)}, re-using unchanged hashes"""
+        states = {}
+        for fname in files:
+            path = os.path.join(topdir, fname)
+            try:
+                st = os.stat(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                states[fname] = None
+                continue
+            old = old_states.get(fname)
+            if old and old[0] == st.st_size and old[1] == st.st_mtime:
+                states[fname] = old
+            else:
+                states[fname] = (st.st_size, st.st_mtime, hash_file(path, st))
+        return states
+
+    def is_current(self, stage, topdir, files, extra=None):
+        """Check whether stage has run with the same input files and extra"""
+        if stage not in self.stages:
+            logging.debug("Stage %s has never run", stage)
+            return False
+        old_extra, old_states, digest = self.stages[stage]
+        if old_extra != extra:
+            logging.debug("Stage %s has new parameters", stage)
+            return False
+        if set(files) != set(old_states.keys()):
+            logging.debug("Stage %s has new or removed input files", stage)
+            return False
+        touched = False
+        for fname in files:
+            old = old_states[fname]
+            path = os.path.join(topdir, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                if old is None:
+                    continue
+                logging.debug("Stage %s input %s has vanished", stage, fname)
+                return False
+            if old is None or old[0] != st.st_size:
+                logging.debug("Stage %s input %s has changed", stage, fname)
+                return False
+            if old[1] != st.st_mtime:
+                if old[2] is None or old[2] != hash_file(path, st):
+                    logging.debug("Stage %s input %s has changed",
+                                  stage, fname)
+                    return False
+                old_states[fname] = (old[0], st.st_mtime, old[2])
+                touched = True
+        if touched:
+            # Remember new mtimes so the files need not be hashed again
+            try:
+                self._save()
+            except (IOError, OSError), e:
+                logging.debug("Cannot write stage state %s: %s",
+                              repr(self.filename), e)
+        return True
+
+    def record(self, stage, topdir, files, extra=None):
+        """Remember that stage has just run successfully"""
+        old_states = {}
+        if stage in self.stages:
+            old_states = self.stages[stage][1]
+        states = self._file_states(topdir, files, old_states)
+        md5 = hashlib.md5(repr(extra))
+        for fname in files:
+            md5.update("\0%s\0%s" % (fname, states[fname] and states[fname][2]))
+        self.stages[stage] = (extra, states, md5.hexdigest())
+        self._save()
+
+    def digest(self, stage):
+        """Return digest of stage's recorded inputs, or None"""
+        if stage in self.stages:
+            return self.stages[stage][2]
+        return None
+
+    def forget(self, stage):
+        """Mark stage as out of date"""
+        if stage in self.stages:
+            del self.stages[stage]
+            self._save()
@@ -0,0 +1,144 @@
+"""\
+nbblib.trace - time what nbb does and write it as a Chrome trace
+Copyright (C) 2008 Hans Ulrich Niedermann <hun@n-dimensional.de>
+
+With --trace=FILE, every program nbb runs and every internal phase
+(plugin detection, config lookups, build stages) is recorded as a
+complete event ("ph": "X") in the Chrome trace event format, and
+written to FILE when nbb exits. Load FILE in chrome://tracing or
+https://ui.perfetto.dev to look at it.
+
+Code to be timed is wrapped in a Span:
+
+    span = trace.Span('configure', 'stage')
+    try:
+        ...
+    finally:
+        span.end()
+
+Without --trace, a span costs just one time() call. Writing the trace
+file needs the json module (Python 2.6 or later).
+"""
+
+
+import os
+import time
+import thread
+import logging
+import threading
+
+
+__all__ = []
+
+
+class Tracer(object):
+    """Collects trace events and writes them to a file"""
+
+    def __init__(self, filename):
+        super(Tracer, self).__init__()
+        self.filename = filename
+        self.pid = os.getpid()
+        self.events = []
+        self.lock = threading.Lock()
+        self.tids = {}
+
+    def _tid(self, tid):
+        """Map thread idents and other lane keys to small numbers"""
+        if tid is None:
+            tid = thread.get_ident()
+        if tid not in self.tids:
+            self.tids[tid] = len(self.tids) + 1
+        return self.tids[tid]
+
+    def add(self, name, cat, start, end, args=None, tid=None):
+        event = {'name': name,
+                 'cat': cat,
+                 'ph': 'X',
+                 'ts': int(start * 1000000),
+                 'dur': int((end - start) * 1000000),
+                 'pid': self.pid,
+                 }
+        if args:
+            event['args'] = args
+        self.lock.acquire()
+        try:
+            event['tid'] = self._tid(tid)
+            self.events.append(event)
+        finally:
+            self.lock.release()
+
+    def write(self):
+        # Only --trace needs json, so nbb runs without it otherwise
+        try:
+            import json
+        except ImportError:
+            logging.error("Cannot write trace to %s: No json module",
+                          repr(self.filename))
+            return
+        self.lock.acquire()
+        try:
+            data = json.dumps({'traceEvents': self.events,
+                               'displayTimeUnit': 'ms'})
+        finally:
+            self.lock.release()
+        f = open(self.filename, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        logging.debug("Wrote %d trace events to %s",
+                      len(self.events), repr(self.filename))
+
+
+_tracer = None
+
+
+__all__.append('enable')
+def enable(filename):
+    """Start recording trace events, to be written to filename"""
+    global _tracer
+    _tracer = Tracer(os.path.abspath(filename))
+
+
+__all__.append('enabled')
+def enabled():
+    return _tracer is not None
+
+
+__all__.append('add_event')
+def add_event(name, cat, start, end, args=None, tid=None):
+    """Record event from time start to end (as from time.time())
+
+    Events with the same tid are shown in the same lane, which by
+    default is the calling thread's.
+    """
+    if _tracer:
+        _tracer.add(name, cat, start, end, args, tid)
+
+
+__all__.append('write')
+def write():
+    """Write the recorded events, if tracing"""
+    if _tracer:
+        _tracer.write()
+
+
+__all__.append('Span')
+class Span(object):
+    """Time from creating the span until calling its end() method"""
+
+    def __init__(self, name, cat, args=None):
+        super(Span, self).__init__()
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = time.time()
+
+    def end(self, **args):
+        """Record the span, with more event args if given"""
+        if _tracer:
+            if args:
+                self.args = dict(self.args or {})
+                self.args.update(args)
+            _tracer.add(self.name, self.cat, self.start, time.time(),
+                        self.args)
@@ -4,13 +4,20 @@ VCS Source Tree plugin system
 
 
 import os
+import re
 import logging
 import urlparse
+import hashlib
 import itertools
 
+from nbblib import cache
+from nbblib import conffile
+from nbblib import gitrepo
 from nbblib import package
 from nbblib import progutils
 from nbblib import plugins
+from nbblib import stamps
+from nbblib import trace
 
 
 __all__ = []
@@ -36,6 +43,115 @@ class AbstractConfig(object):
         return os.path.join(self._srcdir, "_install", self._nick)
     installdir = property(get_installdir)
 
+    def get_jobs(self):
+        """Number of parallel build jobs, or None to choose automatically"""
+        return None
+    jobs = property(get_jobs)
+
+    def get_ccache(self):
+        """Compiler cache size limit ('on' for ccache's), or None if off"""
+        return None
+    ccache = property(get_ccache)
+
+    def set_items(self, items):
+        """Set several config items at once, e.g. {'builddir': '_b'}"""
+        keys = items.keys()
+        keys.sort()
+        for key in keys:
+            setattr(self, key, items[key])
+
+
+_ccache_size_re = re.compile(r'^[0-9]+(\.[0-9]+)?[kMGT]?$')
+
+
+__all__.append('valid_ccache_value')
+def valid_ccache_value(value):
+    """Check config value for the compiler cache: 'on', 'off' or a size"""
+    return value in ('on', 'off') or bool(_ccache_size_re.match(value))
+
+
+class FileConfig(AbstractConfig):
+    """Config read from and written to ${srcdir}/.nbb.conf
+
+    Items not set in the file are looked up in the fallback config if
+    there is one (e.g. a GitConfig, for values set with 'git config'
+    by older nbb versions, or the main work tree's FileConfig for a
+    'git worktree' checkout), and then default to the static values.
+    Setting items always writes this work tree's own file.
+    """
+
+    def __init__(self, srcdir, nick, fallback=None):
+        super(FileConfig, self).__init__(srcdir, nick)
+        self._filename = os.path.join(srcdir, conffile.CONFIG_FILE_NAME)
+        self._fallback = fallback
+
+    def _get_item(self, item):
+        """Return value of config item, or None if unset"""
+        span = trace.Span('config %s' % item, 'config')
+        value = conffile.read(self._filename).get(item)
+        if value is None and self._fallback is not None:
+            value = self._fallback._get_item(item)
+        span.end(value=value)
+        return value
+
+    def set_items(self, items):
+        """Write several config items to the config file in one go"""
+        conffile.update(self._filename, items)
+
+    def get_builddir(self):
+        value = self._get_item('builddir')
+        if value:
+            return os.path.join(self._srcdir, value, self._nick)
+        else:
+            return super(FileConfig, self).get_builddir()
+
+    def set_builddir(self, value):
+        self.set_items({'builddir': value})
+
+    builddir = property(get_builddir, set_builddir)
+
+    def get_installdir(self):
+        value = self._get_item('installdir')
+        if value:
+            return os.path.join(self._srcdir, value, self._nick)
+        else:
+            return super(FileConfig, self).get_installdir()
+
+    def set_installdir(self, value):
+        self.set_items({'installdir': value})
+
+    installdir = property(get_installdir, set_installdir)
+
+    def get_jobs(self):
+        value = self._get_item('jobs')
+        if not value or value == 'auto':
+            return None
+        try:
+            jobs = int(value)
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            raise RuntimeError("Invalid jobs config value %s" % repr(value))
+        return jobs
+
+    def set_jobs(self, value):
+        self.set_items({'jobs': value})
+
+    jobs = property(get_jobs, set_jobs)
+
+    def get_ccache(self):
+        value = self._get_item('ccache')
+        if not value or value == 'off':
+            return None
+        if value != 'on' and not _ccache_size_re.match(value):
+            raise RuntimeError("Invalid ccache config value %s" % repr(value))
+        return value
+
+    def set_ccache(self, value):
+        self.set_items({'ccache': value})
+
+    ccache = property(get_ccache, set_ccache)
+
 
 class NotAVCSourceTree(plugins.PluginNoMatch):
     def __init__(self, srcdir):
@@ -90,13 +206,36 @@ class VCSourceTree(plugins.GenericDetectPlugin):
 
         @param srcdir string with absolute path of source code directory
         """
-        return super(VCSourceTree, cls).detect(context, srcdir)
+        span = trace.Span('detect vcs', 'detect', {'srcdir': srcdir})
+        try:
+            dcache = cache.DetectionCache(context, srcdir)
+            name = dcache.lookup('vcs')
+            if name in cls.plugins:
+                try:
+                    return cls.detect_named(name, context, srcdir)
+                except plugins.PluginNoMatch:
+                    logging.debug("Cached VCS type %s does not match", name)
+            obj = super(VCSourceTree, cls).detect(context, srcdir)
+            dcache.store('vcs', obj.name, obj.tree_root,
+                         cls.all_fingerprint_files())
+            return obj
+        finally:
+            span.end()
+
+    _config = None
 
     def get_config(self):
         """Get configuration object which determines builddir etc"""
-        return AbstractConfig(self.tree_root, self.branch_name)
+        if self._config is None:
+            self._config = FileConfig(self.tree_root, self.branch_name,
+                                      fallback=self._get_fallback_config())
+        return self._config
     config = property(get_config)
 
+    def _get_fallback_config(self):
+        """Return VCS specific config to use for items not in .nbb.conf"""
+        return None
+
     @plugins.abstractmethod
     def _get_tree_root(self):
         """Get absolute path to source tree root"""
@@ -115,6 +254,14 @@ class VCSourceTree(plugins.GenericDetectPlugin):
         return self._get_branch_name()
     branch_name = property(get_branch_name)
 
+    def content_id(self, files):
+        """Return id of the work tree contents, or None if unknown
+
+        @param files the source files (relative to the tree root) whose
+                     contents count even if not under version control
+        """
+        return None
+
     def __str__(self):
         return repr(self)
 
@@ -131,37 +278,191 @@ class VCSourceTree(plugins.GenericDetectPlugin):
 class GitSourceTree(VCSourceTree):
 
     name = 'git'
+    fingerprint_files = ('.git', '.git/HEAD', )
 
     def __init__(self, context, srcdir):
         super(GitSourceTree, self).__init__(context)
-        os.chdir(srcdir)
-        if "true" != progutils.prog_stdout(["git", "rev-parse",
-                                            "--is-inside-work-tree"]):
+        self.__head_ref = None
+        try:
+            self.__repo = gitrepo.find_repository(srcdir)
+        except gitrepo.UnsupportedRepository, e:
+            logging.debug("%s, asking git", e)
+            self.__repo = None
+            self.__probe_with_git(srcdir)
+        else:
+            if self.__repo is None:
+                raise self.no_match_exception(srcdir)
+            self.__tree_root = self.__repo.work_tree
+
+    def __probe_with_git(self, srcdir):
+        # Do not chdir(), as detection may run in multiple threads.
+        # Gather work tree check, tree root, and the ref HEAD points to
+        # with a single git process.
+        lines = progutils.prog_stdout(["git", "rev-parse",
+                                       "--is-inside-work-tree",
+                                       "--show-toplevel",
+                                       "--symbolic-full-name", "HEAD"],
+                                      cwd=srcdir).splitlines()
+        if len(lines) < 2 or lines[0] != "true":
             raise self.no_match_exception(srcdir)
-        reldir = progutils.prog_stdout(["git", "rev-parse", "--show-cdup"])
-        if reldir:
-            os.chdir(reldir)
-        self.__tree_root = os.getcwd()
+        self.__tree_root = os.path.realpath(lines[1])
+        if len(lines) > 2 and lines[2].startswith('refs/'):
+            self.__head_ref = lines[2]
 
-    def get_config(self):
-        return GitConfig(self.tree_root, self.branch_name)
-    config = property(get_config)
+    def _get_fallback_config(self):
+        """Return config for items not in this work tree's .nbb.conf
+
+        'git config' is shared by all work trees of a repository, so in
+        a 'git worktree' checkout the main work tree's .nbb.conf is
+        looked at before it.
+        """
+        fallback = GitConfig(self.tree_root, self.branch_name,
+                             repo=self.__repo)
+        main_root = self._get_main_tree_root()
+        if main_root is not None and main_root != self.tree_root:
+            fallback = FileConfig(main_root, self.branch_name,
+                                  fallback=fallback)
+        return fallback
+
+    def _get_main_tree_root(self):
+        """Return main work tree root of a 'git worktree' checkout, or None"""
+        if self.__repo is not None:
+            git_dir = self.__repo.git_dir
+            common_dir = self.__repo.common_dir
+        else:
+            lines = progutils.prog_stdout(["git", "rev-parse", "--git-dir",
+                                           "--git-common-dir"],
+                                          cwd=self.tree_root).splitlines()
+            if len(lines) < 2:
+                return None
+            git_dir, common_dir = [os.path.normpath(os.path.join(self.tree_root,
+                                                                 d))
+                                   for d in lines[:2]]
+        if common_dir == git_dir or os.path.basename(common_dir) != '.git':
+            # Not a linked work tree, or one of a bare repository
+            return None
+        return os.path.dirname(common_dir)
 
     def _get_tree_root(self):
         return self.__tree_root
 
+    def _get_head_ref(self):
+        if self.__head_ref is None and self.__repo is not None:
+            try:
+                self.__head_ref = self.__repo.head_ref
+            except gitrepo.UnsupportedRepository, e:
+                logging.debug("%s, asking git", e)
+        if self.__head_ref is None:
+            # Detached HEAD, or rev-parse could not resolve HEAD on a
+            # branch without commits.
+            self.__head_ref = progutils.prog_stdout(["git", "symbolic-ref",
+                                                     "HEAD"],
+                                                    cwd=self.tree_root)
+        return self.__head_ref
+
     def _get_branch_name(self):
-        bname = progutils.prog_stdout(["git", "symbolic-ref", "HEAD"])
-        refs, heads, branch = bname.split('/')
+        refs, heads, branch = self._get_head_ref().split('/', 2)
         assert(refs=='refs' and heads=='heads')
         return branch
 
+    def local_branches(self):
+        """Return sorted list of local branch names"""
+        branches = progutils.prog_stdout(["git", "for-each-ref",
+                                          "--format=%(refname)",
+                                          "refs/heads/"],
+                                         cwd=self.tree_root).splitlines()
+        branches = [ b[len('refs/heads/'):] for b in branches ]
+        branches.sort()
+        return branches
+
+    def worktrees(self):
+        """Return dict mapping branch names to their work tree directories"""
+        stdout = progutils.prog_stdout(["git", "worktree", "list",
+                                        "--porcelain"],
+                                       cwd=self.tree_root)
+        result = {}
+        path = None
+        for line in stdout.splitlines():
+            if line.startswith('worktree '):
+                path = line[len('worktree '):]
+            elif line.startswith('branch refs/heads/') and path:
+                result[line[len('branch refs/heads/'):]] = path
+        return result
+
+    def __ls_files(self, runner, *args):
+        """Start 'git ls-files' in runner, returning the progutils.Job"""
+        return runner.capture(["git", "ls-files", "-z"] + list(args),
+                              cwd=self.tree_root)
+
+    def __listed(self, job):
+        """Return set of file names listed by an __ls_files job, or None"""
+        if job.returncode != 0:
+            logging.debug("Cannot list files in %s: %s",
+                          repr(self.tree_root), job.stderr.strip())
+            return None
+        return set([ fname for fname in job.stdout.split('\0') if fname ])
+
+    def content_id(self, files):
+        """Return id of the work tree contents as seen by git
+
+        That is a hash of the index entries (mode, blob id and stage of
+        every file), and of the contents of the files differing from
+        the index and of the untracked ones among files. Unlike 'git
+        write-tree', this does not write to the repository, and works
+        with an unmerged index, too.
+        """
+        # The three git commands do not depend on each other
+        runner = progutils.ProgramRunner(3)
+        ls_index = runner.capture(["git", "ls-files", "-s", "-z"],
+                                  cwd=self.tree_root)
+        ls_changed = self.__ls_files(runner, "--modified", "--deleted")
+        ls_untracked = self.__ls_files(runner, "--others",
+                                       "--exclude-standard")
+        runner.wait()
+        if ls_index.returncode != 0:
+            logging.debug("Cannot list index of %s: %s",
+                          repr(self.tree_root), ls_index.stderr.strip())
+            return None
+        index_id = hashlib.md5(ls_index.stdout).hexdigest()
+        changed = self.__listed(ls_changed)
+        untracked = self.__listed(ls_untracked)
+        if changed is None or untracked is None:
+            return None
+        changed.update(untracked.intersection(files))
+        if not changed:
+            return index_id
+        changed = list(changed)
+        changed.sort()
+        md5 = hashlib.md5(index_id)
+        for fname in changed:
+            path = os.path.join(self.tree_root, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            md5.update("\0%s\0%s" % (fname, st and stamps.hash_file(path, st)))
+        return md5.hexdigest()
+
+    def add_worktree(self, path, branch):
+        """Check out branch into a new work tree at path"""
+        os.chdir(self.tree_root)
+        progutils.prog_run(["git", "worktree", "add", path, branch],
+                           self.context)
+
 
 class GitConfig(AbstractConfig):
-    """git config interface"""
+    """git config interface
 
-    def __init__(self, *args, **kwargs):
-        super(GitConfig, self).__init__(*args, **kwargs)
+    All nbb.* config values are read at once on first access: directly
+    from the config files via repo (a gitrepo.GitRepository) if possible,
+    and with a single 'git config --get-regexp' otherwise. Setting values
+    runs 'git config' and drops that snapshot.
+    """
+
+    def __init__(self, srcdir, nick, repo=None):
+        super(GitConfig, self).__init__(srcdir, nick)
+        self._repo = repo
+        self._snapshot = None
 
     def _itemname(self, item):
         return '.'.join((package.GIT_CONFIG_PREFIX, item, ))
@@ -169,31 +470,87 @@ class GitConfig(AbstractConfig):
     def _myreldir(self, rdir):
         return os.path.join(self._srcdir, rdir, self._nick)
 
-    def get_builddir(self):
-        ret, stdout, stderr = progutils.prog_retstd(['git', 'config', self._itemname('builddir')])
+    def _load_snapshot(self):
+        """Return dict with all nbb.* config keys and their values"""
+        prefix = self._itemname('')
+        if self._repo is not None:
+            try:
+                snapshot = {}
+                for key, value in self._repo.config:
+                    if key.startswith(prefix):
+                        if value is None:
+                            value = ''
+                        snapshot[key] = value
+                return snapshot
+            except gitrepo.UnsupportedRepository, e:
+                logging.debug("%s, asking git", e)
+        ret, stdout, stderr = progutils.prog_retstd(['git', 'config', '-z',
+                                                     '--get-regexp',
+                                                     '^%s\\.' % package.GIT_CONFIG_PREFIX],
+                                                    cwd=self._srcdir)
         assert(stderr == "")
-        if ret == 0 and stdout:
-            return self._myreldir(stdout)
+        snapshot = {}
+        if ret == 0:
+            # -z: "key\nvalue\0" for each item, "key\0" if no value
+            for entry in stdout.split('\0'):
+                if entry:
+                    key, value = (entry.split('\n', 1) + [''])[:2]
+                    snapshot[key] = value
+        return snapshot
+
+    def _get_snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = self._load_snapshot()
+            logging.debug("git config snapshot: %s", self._snapshot)
+        return self._snapshot
+
+    def _get_item(self, item):
+        """Return value of config item, or None if unset"""
+        return self._get_snapshot().get(self._itemname(item))
+
+    def set_items(self, items):
+        """Write several config items, then re-read config on next access
+
+        Values which are already set as given are not written again.
+        """
+        snapshot = self._get_snapshot()
+        keys = items.keys()
+        keys.sort()
+        for item in keys:
+            name = self._itemname(item)
+            if snapshot.get(name) == items[item]:
+                continue
+            ret, stdout, stderr = progutils.prog_retstd(['git', 'config', name, items[item]],
+                                                        cwd=self._srcdir)
+            assert(ret == 0 and stdout == "" and stderr == "")
+        self._snapshot = None
+        if self._repo is not None:
+            self._repo.forget_config()
+
+    def _set_item(self, item, value):
+        self.set_items({item: value})
+
+    def get_builddir(self):
+        value = self._get_item('builddir')
+        if value:
+            return self._myreldir(value)
         else:
             return super(GitConfig, self).get_builddir()
 
     def set_builddir(self, value):
-        ret, stdout, stderr = progutils.prog_retstd(['git', 'config', self._itemname('builddir'), value])
-        assert(ret == 0 and stdout == "" and stderr == "")
+        self._set_item('builddir', value)
 
     builddir = property(get_builddir, set_builddir)
 
     def get_installdir(self):
-        ret, stdout, stderr = progutils.prog_retstd(['git', 'config', self._itemname('installdir')])
-        assert(stderr == "")
-        if ret == 0 and stdout:
-            return self._myreldir(stdout)
+        value = self._get_item('installdir')
+        if value:
+            return self._myreldir(value)
         else:
             return super(GitConfig, self).get_installdir()
 
     def set_installdir(self, value):
-        ret, stdout, stderr = progutils.prog_retstd(['git', 'config', self._itemname('installdir'), value])
-        assert(ret == 0 and stdout == "" and stderr == "")
+        self._set_item('installdir', value)
 
     installdir = property(get_installdir, set_installdir)
 
@@ -201,9 +558,63 @@ class GitConfig(AbstractConfig):
 class BzrSourceTree(VCSourceTree):
 
     name = 'bzr'
+    fingerprint_files = ('.bzr', '.bzr/branch/branch.conf', )
 
     def __init__(self, context, srcdir):
         super(BzrSourceTree, self).__init__(context)
+        bzr_root = self.__find_bzr_dir(srcdir)
+        if bzr_root is None:
+            logging.debug("Not a bzr branch: %s", repr(srcdir))
+            raise self.no_match_exception(srcdir)
+        if not self.__read_markers(bzr_root):
+            self.__open_with_bzrlib(srcdir)
+
+    def __find_bzr_dir(self, srcdir):
+        """Return the closest directory above srcdir with a .bzr directory"""
+        curdir = os.path.abspath(srcdir)
+        while True:
+            if os.path.isdir(os.path.join(curdir, '.bzr')):
+                return curdir
+            parent = os.path.dirname(curdir)
+            if parent == curdir:
+                return None
+            curdir = parent
+
+    def __read_markers(self, bzr_root):
+        """Get tree root and nick from a standalone branch's .bzr files
+
+        Returns False for everything else (shared repositories,
+        lightweight checkouts, etc.), which only bzrlib can handle.
+        """
+        bzrdir = os.path.join(bzr_root, '.bzr')
+        if not (os.path.isdir(os.path.join(bzrdir, 'checkout')) and
+                os.path.isdir(os.path.join(bzrdir, 'branch')) and
+                not os.path.exists(os.path.join(bzrdir, 'branch', 'location'))):
+            return False
+        self.__tree_root = bzr_root
+        self.__nick = os.path.basename(bzr_root)
+        try:
+            f = open(os.path.join(bzrdir, 'branch', 'branch.conf'), 'r')
+        except IOError:
+            return True
+        try:
+            for line in f:
+                if '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                if key.strip() == 'nickname':
+                    value = value.strip()
+                    if len(value) > 1 and value[0] == value[-1] == '"':
+                        value = value[1:-1]
+                    if value:
+                        self.__nick = value
+        finally:
+            f.close()
+        logging.debug("bzr branch %s with nick %s from marker files",
+                      repr(self.__tree_root), repr(self.__nick))
+        return True
+
+    def __open_with_bzrlib(self, srcdir):
         try:
             import bzrlib.errors
             import bzrlib.workingtree
@@ -215,23 +626,16 @@ class BzrSourceTree(VCSourceTree):
         except ImportError, e:
             logging.warning("Cannot load bzrlib.*", exc_info=e)
             raise self.no_match_exception(srcdir)
-        self.wt = wt
-        #print "wt:", wt
-        #print "wt:", dir(wt)
-        #print "wt.branch:", wt.branch
-        #print "wt.branch:", dir(wt.branch)
-        #print "wt.branch.nick:", wt.branch.nick
-        #print "wt.branch.abspath:", wt.branch.abspath
-        #print "wt.branch.base:", wt.branch.base
-        #print "wt.branch.basis_tree:", wt.branch.basis_tree()
-
-    def _get_tree_root(self):
-        proto, host, path, some, thing = urlparse.urlsplit(self.wt.branch.base)
+        proto, host, path, some, thing = urlparse.urlsplit(wt.branch.base)
         assert(proto == "file" and host == "")
         assert(some == "" and thing == "")
-        return os.path.abspath(path)
+        self.__tree_root = os.path.abspath(path)
+        self.__nick = wt.branch.nick
+
+    def _get_tree_root(self):
+        return self.__tree_root
 
     def _get_branch_name(self):
-        return self.wt.branch.nick
+        return self.__nick
 
 